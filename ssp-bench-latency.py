@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+
+
+from ssp.server import Server, Universe
+from ssp.server.metrics import Histogram
+from ssp.scripting.emulator import load_program
+from ssp.scripting.assembler import Assembler
+from ssp.scripting.source import FileSource
+import concurrent.futures
+import argparse
+import asyncio
+import io
+
+
+# a process that never blocks, so it uses its whole step allowance every tick
+BUSY_PROGRAM = """
+label start
+	push 1
+	pop 1
+	jmp start
+"""
+
+# seconds between requests
+REQUEST_INTERVAL = 0.005
+
+
+def assemble(text):
+	output = io.BytesIO()
+	messages = Assembler().assemble(FileSource(io.StringIO(text), "busy"), output)
+	if len(messages) > 0:
+		raise Exception("\n".join(map(str, messages)))
+	output.seek(0)
+	return load_program(output)
+
+
+def measure(busy_processes, off_loop, requests, tick_rate):
+	loop = asyncio.new_event_loop()
+	asyncio.set_event_loop(loop)
+
+	tick_executor = None
+	if off_loop:
+		tick_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+	universe = Universe()
+	server = Server(loop, universe, tick_rate=tick_rate, tick_executor=tick_executor)
+	program = assemble(BUSY_PROGRAM)
+	for _ in range(busy_processes):
+		universe.create_machine().start_process(program)
+
+	latency = Histogram()
+
+	async def run():
+		server.start()
+		target = universe.machines['test']
+		started = loop.time()
+		for index in range(requests):
+			# requests arrive on a fixed schedule and latency is measured from
+			# when they were due, so time spent stuck behind a tick is counted
+			due = started + index * REQUEST_INTERVAL
+			await asyncio.sleep(max(0.0, due - loop.time()))
+			# the same work the /machines/<id>/send endpoint does per request
+			await target.interface_send('fs', ['open', 'bench.txt', 'r'])
+			latency.record(loop.time() - due)
+		server.stop()
+		await server.wait_finished()
+
+	loop.run_until_complete(run())
+	loop.close()
+	if tick_executor is not None:
+		tick_executor.shutdown()
+
+	return latency, server.metrics
+
+
+def main():
+	args = get_args()
+
+	print("{:<10} {:<8} {:>10} {:>10} {:>10} {:>12}".format(
+		"busy", "ticks", "p50 (ms)", "p99 (ms)", "max (ms)", "tick p50 (ms)"
+	))
+	for busy in (0, args.busy):
+		for off_loop in (False, True):
+			latency, metrics = measure(busy, off_loop, args.requests, args.tick_rate)
+			print("{:<10} {:<8} {:>10.2f} {:>10.2f} {:>10.2f} {:>12.2f}".format(
+				busy, "off-loop" if off_loop else "on-loop",
+				latency.percentile(0.5) * 1000, latency.percentile(0.99) * 1000,
+				latency.max * 1000, (metrics.duration.percentile(0.5) or 0) * 1000
+			))
+
+
+def get_args():
+	parser = argparse.ArgumentParser(
+		description='measures request latency with and without a saturated tick'
+	)
+	parser.add_argument(
+		'-b', '--busy', type=int, default=200,
+		help='number of never-blocking processes used to saturate the tick'
+	)
+	parser.add_argument(
+		'-n', '--requests', type=int, default=200,
+		help='number of requests to time for each configuration'
+	)
+	parser.add_argument(
+		'-r', '--tick-rate', type=float, default=Server.TICK_RATE,
+		help='ticks per second'
+	)
+	return parser.parse_args()
+
+
+if __name__ == "__main__":
+	main()
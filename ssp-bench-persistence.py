@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+
+
+from ssp.server import Universe
+from ssp.server.universe.persistence import Persistence
+import argparse
+import tempfile
+import shutil
+import time
+import os
+
+
+def timed(fn):
+	start = time.perf_counter()
+	result = fn()
+	return time.perf_counter() - start, result
+
+
+def report(name, elapsed, machines, path=None):
+	size = ""
+	if path is not None:
+		size = "{:.1f}".format(os.path.getsize(path) / (1024.0 * 1024.0))
+	print("{:<10} {:>10} {:>10.3f} {:>14.0f} {:>10}".format(
+		name, machines, elapsed, machines / elapsed if elapsed > 0 else 0, size
+	))
+
+
+def main():
+	args = get_args()
+	path = args.dir or tempfile.mkdtemp(prefix="ssp-bench-")
+
+	try:
+		universe = Universe()
+		persistence = Persistence(universe, path)
+
+		print("creating {} machines".format(args.machines))
+		for _ in range(args.machines):
+			universe.create_player_machine()
+		count = len(universe.machines)
+
+		print("{:<10} {:>10} {:>10} {:>14} {:>10}".format(
+			"phase", "machines", "time (s)", "machines/s", "size (MiB)"
+		))
+
+		# creating the machines dirtied them all, which is measured as the log
+		persistence.dirty.clear()
+
+		# the snapshot includes the time taken to write it out
+		elapsed, _ = timed(lambda: (
+			persistence.snapshot(), persistence.finish_snapshot(), persistence.wait()
+		))
+		report("snapshot", elapsed, count, persistence.snapshot_path)
+
+		for mach in universe.machines.values():
+			mach.mark_dirty()
+		elapsed, _ = timed(lambda: (persistence.flush_log(), persistence.wait()))
+		report("log", elapsed, count, persistence.log_path)
+
+		restored = Universe()
+		elapsed, restored_count = timed(lambda: Persistence(restored, path).restore())
+		report("restore", elapsed, restored_count)
+	finally:
+		if args.dir is None:
+			shutil.rmtree(path)
+
+
+def get_args():
+	parser = argparse.ArgumentParser(
+		description='measures snapshot, log and restore throughput of universe persistence'
+	)
+	parser.add_argument(
+		'-m', '--machines', type=int, default=100000,
+		help='number of player machines to persist'
+	)
+	parser.add_argument(
+		'-d', '--dir',
+		help='directory to persist to (a temporary directory is used and removed by default)'
+	)
+	return parser.parse_args()
+
+
+if __name__ == "__main__":
+	main()
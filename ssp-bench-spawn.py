@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+
+
+from ssp.server import Universe
+from ssp.scripting.emulator import load_program
+from ssp.scripting.assembler import Assembler
+from ssp.scripting.source import FileSource
+import argparse
+import logging
+import time
+import io
+
+
+# a process that does a little work then asks sys to let it exit
+SHORT_PROGRAM = """
+	push 1
+	pop 1
+	push ["sys", "exit"]
+	sendi
+"""
+
+
+def assemble(text):
+	output = io.BytesIO()
+	messages = Assembler().assemble(FileSource(io.StringIO(text), "short"), output)
+	if len(messages) > 0:
+		raise Exception("\n".join(map(str, messages)))
+	output.seek(0)
+	return load_program(output)
+
+
+def measure(pool_size, rounds, batch):
+	universe = Universe(process_pool_size=pool_size)
+	machine = universe.create_player_machine()
+	program = assemble(SHORT_PROGRAM)
+
+	start = time.perf_counter()
+	for _ in range(rounds):
+		for _ in range(batch):
+			machine.start_process(program)
+		# one tick runs every process until it exits, and exited processes
+		# are recycled at the start of the next
+		universe.tick()
+	elapsed = time.perf_counter() - start
+
+	return elapsed, len(machine.processes), universe.process_pool
+
+
+def main():
+	args = get_args()
+	# per-process logging would swamp the measurement
+	logging.disable(logging.CRITICAL)
+
+	print("{:<8} {:>10} {:>16} {:>10} {:>10}".format(
+		"pool", "time (s)", "spawns/s", "hits", "processes"
+	))
+	for pool_size in (0, args.pool_size):
+		elapsed, processes, pool = measure(pool_size, args.rounds, args.batch)
+		spawns = args.rounds * args.batch
+		print("{:<8} {:>10.3f} {:>16.0f} {:>10} {:>10}".format(
+			pool_size, elapsed, spawns / elapsed, pool.hits, processes
+		))
+
+
+def get_args():
+	parser = argparse.ArgumentParser(
+		description='measures how fast short-lived processes can be spawned and reaped'
+	)
+	parser.add_argument(
+		'-p', '--pool-size', type=int, default=64,
+		help='size of the process pool to compare against no pool'
+	)
+	parser.add_argument(
+		'-r', '--rounds', type=int, default=200,
+		help='ticks to run'
+	)
+	parser.add_argument(
+		'-b', '--batch', type=int, default=50,
+		help='processes spawned before each tick'
+	)
+	return parser.parse_args()
+
+
+if __name__ == "__main__":
+	main()
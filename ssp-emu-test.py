@@ -3,6 +3,7 @@
 
 from ssp.scripting.emulator import Emulator, load_program, BlockingReason
 import argparse
+import time
 
 
 class EmuTest(object):
@@ -80,6 +81,14 @@ class EmuTest(object):
 
 	def _on_block(self, emu, reason):
 		print("blocked on", BlockingReason.to_string(reason))
+		# nothing else will ever wake the emulator, so timed blocks just wait
+		# out their timeout
+		if emu.block_timeout is not None:
+			time.sleep(emu.block_timeout / 1000.0)
+			if reason == BlockingReason.SLEEP:
+				emu.resume()
+			else:
+				emu.receive_timeout()
 
 	def _svc_sys(self, values):
 		if len(values) > 0 and values[0] == 'ls':
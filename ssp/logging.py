@@ -2,6 +2,27 @@ import logging
 import logging.handlers
 import urllib.parse
 
+def forget_loggers(logger):
+    """
+    Drops a logger and all of its descendants from the logging module's
+    registry, which otherwise keeps every logger ever created alive.
+    """
+    manager = logging.Logger.manager
+    prefix = logger.name + '.'
+    names = [
+        name for name in list(manager.loggerDict.keys())
+        if (name == logger.name) or name.startswith(prefix)
+    ]
+    for name in names:
+        manager.loggerDict.pop(name, None)
+
+def forget_logger(logger):
+    """
+    Drops just the one logger from the registry, for loggers known not to
+    have children.
+    """
+    logging.Logger.manager.loggerDict.pop(logger.name, None)
+
 def start_network_logging(url):
     url = urllib.parse.urlparse(url)
     handler = logging.handlers.SocketHandler(url.hostname, url.port or logging.handlers.DEFAULT_TCP_LOGGING_PORT)
@@ -1,13 +1,18 @@
 
 
-from .parser import Parser, Instruction, Node, NodeType
+from .parser import Parser, Instruction, Node, DataNode, NodeType
 from ..opcode import Opcode
+from ..data import (
+	DataRef, DATA_SECTION_MARKER, MAX_DATA_SIZE, pack_default, read_program
+)
 from .lexer import Lexer
 
 
 from collections import namedtuple
+import contextlib
 import traceback
 import msgpack
+import json
 
 
 class ErrorLevel:
@@ -32,13 +37,25 @@ class AssemblerMessage(namedtuple('AssemblerMessage', 'level line col message'))
 		)
 
 
+class Fixup(namedtuple('Fixup', 'index param node expected_types inst')):
+	"""
+	A parameter that couldn't be resolved during ingest because it refers to a
+	label that hadn't been defined yet.
+	"""
+	pass
+
+
 class Assembler(object):
 
-	def __init__(self, verbose=0):
+	def __init__(self, verbose=0, profiler=None):
 		self._current_inst = None
 		self._verbose = verbose
+		self._profiler = profiler
 		self._result = []
 		self._lookup_table = {}
+		self._fixups = []
+		self._data = []
+		self._data_index = {}
 		self._messages = {
 			ErrorLevel.WARNING: [],
 			ErrorLevel.ERROR: [],
@@ -47,15 +64,17 @@ class Assembler(object):
 
 	def assemble(self, source, output):
 		try:
-			self._ingest_pass(source)
+			with self._phase('_ingest_pass'):
+				self._ingest_pass(source)
 
-			# if no errors, do type checking & label replacement pass
-			if len(self.all_errors) == 0:
-				self._lookup_and_type_pass()
+			# resolve the forward label references left over from ingest
+			with self._phase('_backpatch_pass'):
+				self._backpatch_pass()
 
 			# if no errors, do output pass
 			if len(self.all_errors) == 0:
-				self._output_pass(output)
+				with self._phase('_output_pass'):
+					self._output_pass(output)
 		except Exception as ex:
 			self._int_error(self._current_inst, "exception {}: {}".format(
 				ex.__class__.__name__, ex
@@ -69,12 +88,18 @@ class Assembler(object):
 		parser = Parser(lexer)
 		special = {
 			'LABEL': self._label_statement,
+			'DATA': self._data_statement,
 		}
 		offset = 0
 
 		while True:
 			instruction = parser.parse_instruction()
 
+			for syntax_error in parser.pop_errors():
+				self._error(syntax_error, "syntax error: {}".format(
+					syntax_error.message
+				))
+
 			if instruction is None:
 				break
 
@@ -101,59 +126,81 @@ class Assembler(object):
 				))
 				continue
 
-			self._emit(opcode, *instruction.parameters)
+			self._assemble_instruction(instruction, opcode)
 
-	def _lookup_and_type_pass(self):
-		def _check(inst):
-			self._current_inst = inst
+		if self._profiler is not None:
+			self._profiler.count('tokens', lexer.token_count)
+			self._profiler.count('instructions', len(self._result))
+			self._profiler.count('labels', len(self._lookup_table))
 
-			info = Assembler.TYPE_INFO.get(inst.opcode, None)
-			if info is None:
-				self._int_error(inst, "no type info for opcode {}".format(
-					Opcodes.to_string(inst.opcode)
-				))
-				return
-			if len(info) < 1:
-				self._int_error(inst, "malformed type info for opcode {}".format(
-					Opcodes.to_string(inst.opcode)
-				))
-				return
+	def _assemble_instruction(self, inst, opcode):
+		info = Assembler.TYPE_INFO.get(opcode, None)
+		if info is None:
+			self._int_error(inst, "no type info for opcode {}".format(
+				Opcode.to_string(opcode)
+			))
+			return
+		if len(info) < 1:
+			self._int_error(inst, "malformed type info for opcode {}".format(
+				Opcode.to_string(opcode)
+			))
+			return
 
-			max_args = info[0]
-			param_types = info[1:]
+		max_args = info[0]
+		param_types = info[1:]
 
-			if max_args is not None and len(inst.parameters) > max_args:
-				self._error(inst,
-					"too many parameters to opcode {} (max: {})".format(
-						Opcode.to_string(inst.opcode), max_args
-					)
+		if max_args is not None and len(inst.parameters) > max_args:
+			self._error(inst,
+				"too many parameters to opcode {} (max: {})".format(
+					Opcode.to_string(opcode), max_args
 				)
-				return
-
-			parameters = []
-			bad_types = 0
-			for index, param_node in enumerate(inst.parameters):
-				if index < len(param_types):
-					expected_types = param_types[index]
-				else:
-					param_types[-1]
-				okay = self._check_parameter(param_node, expected_types)
-				if not okay:
-					self._error(inst, "param {} of {} is type {}, valid types: {}".format(
-						index + 1, Opcode.to_string(inst.opcode),
-						NodeType.to_string(param_node.type),
-						", ".join(map(NodeType.to_string, expected_types))
-					))
-					bad_types += 1
-				try:
-					parameters.append(param_node.collapse_to_value(self._lookup_table))
-				except KeyError as ke:
-					missing_label = ke.args[0]
-					self._error(inst, "undefined label '{}'".format(missing_label))
+			)
+			return
 
-			return Instruction(inst.opcode, parameters)
+		parameters = []
+		for index, param_node in enumerate(inst.parameters):
+			if index < len(param_types):
+				expected_types = param_types[index]
+			else:
+				expected_types = param_types[-1]
+
+			fixup = Fixup(len(self._result), index, param_node, expected_types, inst)
+			if param_node.type == NodeType.IDENTIFIER and\
+					param_node.value not in self._lookup_table:
+				# forward reference, patched once every label is known
+				self._fixups.append(fixup)
+				parameters.append(None)
+				continue
 
-		self._result = list(map(_check, self._result))
+			self._check_parameter(fixup)
+			try:
+				parameters.append(param_node.collapse_to_value(self._lookup_table))
+			except KeyError:
+				# forward reference nested inside a literal, the type of the
+				# literal itself has already been checked
+				self._fixups.append(fixup._replace(expected_types=None))
+				parameters.append(None)
+
+		self._emit(opcode, *parameters).at(inst.line, inst.col)
+
+	def _backpatch_pass(self):
+		for fixup in self._fixups:
+			self._current_inst = fixup.inst
+			if fixup.expected_types is not None:
+				if fixup.node.value not in self._lookup_table:
+					self._error(fixup.inst, "undefined label '{}'".format(
+						fixup.node.value
+					))
+					continue
+				self._check_parameter(fixup)
+			try:
+				value = fixup.node.collapse_to_value(self._lookup_table)
+			except KeyError as ke:
+				missing_label = ke.args[0]
+				self._error(fixup.inst, "undefined label '{}'".format(missing_label))
+				continue
+			self._result[fixup.index].parameters[fixup.param] = value
+		self._fixups = []
 
 	def _output_pass(self, output):
 		for inst in self._result:
@@ -161,6 +208,10 @@ class Assembler(object):
 			self._write(output, inst.opcode)
 			self._write(output, inst.parameters)
 
+		if len(self._data) > 0:
+			self._write(output, DATA_SECTION_MARKER)
+			self._write(output, self._data)
+
 	def _label_statement(self, inst, offset):
 		if len(inst.parameters) != 1:
 			self._error(inst, "label statements take one identifier parameter")
@@ -173,7 +224,49 @@ class Assembler(object):
 		if label not in self._lookup_table:
 			self._lookup_table[label] = Node(NodeType.INT_LITERAL, offset)
 		else:
-			self._error("redefinition of label '{}'".format(label))
+			self._error(inst, "redefinition of label '{}'".format(label))
+
+	def _data_statement(self, inst, offset):
+		if len(inst.parameters) != 2:
+			self._error(inst, "data statements take an identifier and a literal parameter")
+			return
+		name_node, value_node = inst.parameters
+		if name_node.type != NodeType.IDENTIFIER:
+			self._error(inst, "data statement name must be an identifier")
+			return
+		if value_node.type == NodeType.IDENTIFIER:
+			self._error(inst, "data statement value must be a literal")
+			return
+		name = name_node.value
+		if name in self._lookup_table:
+			self._error(inst, "redefinition of label '{}'".format(name))
+			return
+
+		# identical constants share one entry in the data section
+		try:
+			constant = value_node.collapse_to_value(self._lookup_table)
+		except KeyError as ke:
+			self._error(inst, "data statements can only use labels defined before them, '{}' is not".format(
+				ke.args[0]
+			))
+			return
+		try:
+			packed = msgpack.packb(constant, use_bin_type=True)
+		except (TypeError, ValueError, OverflowError) as ex:
+			self._error(value_node, "data statement value can't be encoded: {}".format(ex))
+			return
+		if len(packed) > MAX_DATA_SIZE:
+			self._error(value_node, "data statement value is {} bytes encoded (max: {})".format(
+				len(packed), MAX_DATA_SIZE
+			))
+			return
+		index = self._data_index.get(packed, None)
+		if index is None:
+			index = len(self._data)
+			self._data.append(packed)
+			self._data_index[packed] = index
+
+		self._lookup_table[name] = DataNode(value_node.type, DataRef(index), constant)
 
 	def get_message_counts(self):
 		return len(self.warnings), len(self.errors), len(self.internal_errors)
@@ -195,22 +288,35 @@ class Assembler(object):
 		return self.errors + self.internal_errors
 
 	def disassemble(self, source, output):
-		unpacker = msgpack.Unpacker(source, encoding='utf8')
+		program, data = read_program(source)
 
-		while True:
-			try:
-				instruction = Instruction.from_unpacker(unpacker)
-			except msgpack.OutOfData:
-				break
+		for index in range(len(data)):
+			output.write("data {} {}\n".format(
+				DataRef(index).label, json.dumps(data[index])
+			))
 
+		for instruction in program:
 			output.write("{}\n".format(instruction.pretty_string()))
 
-	def _check_parameter(self, param_node, expected_type):
-		if param_node.type == NodeType.IDENTIFIER:
-			lookup = self._lookup_table[param_node.value]
-			return expected_type is None or lookup.type in expected_type
-		else:
-			return expected_type is None or param_node.type in expected_type
+	def _check_parameter(self, fixup):
+		param_type = fixup.node.type
+		if param_type == NodeType.IDENTIFIER:
+			param_type = self._lookup_table[fixup.node.value].type
+
+		expected_types = fixup.expected_types
+		if expected_types is not None and param_type not in expected_types:
+			self._error(fixup.inst, "param {} of {} is type {}, valid types: {}".format(
+				fixup.param + 1, fixup.inst.opcode.value.upper(),
+				NodeType.to_string(param_type),
+				", ".join(map(NodeType.to_string, expected_types))
+			))
+			return False
+		return True
+
+	def _phase(self, name):
+		if self._profiler is None:
+			return contextlib.nullcontext()
+		return self._profiler.phase(name)
 
 	def _warn(self, inst, warning):
 		self._message(ErrorLevel.WARNING, inst, warning)
@@ -226,10 +332,12 @@ class Assembler(object):
 		self._messages[level].append(msg)
 
 	def _emit(self, opcode, *parameters):
-		self._result.append(Instruction(opcode, parameters))
+		inst = Instruction(opcode, list(parameters))
+		self._result.append(inst)
+		return inst
 
 	def _write(self, output, value):
-		output.write(msgpack.packb(value, use_bin_type=True))
+		output.write(msgpack.packb(value, use_bin_type=True, default=pack_default))
 
 	TYPE_INFO = {
 		# Opcode: (Max#, TokenTypes for Param #1, TokenTypes for Param #2, ...),
@@ -258,5 +366,7 @@ class Assembler(object):
 		Opcode.JI: (1, (NodeType.INT_LITERAL,)),
 		Opcode.JN: (1, (NodeType.INT_LITERAL,)),
 		Opcode.JMP: (1, (NodeType.INT_LITERAL,)),
+		Opcode.SLEEP: (1, (NodeType.INT_LITERAL, NodeType.REAL_LITERAL)),
+		Opcode.RECVT: (1, (NodeType.INT_LITERAL, NodeType.REAL_LITERAL)),
 	}
 
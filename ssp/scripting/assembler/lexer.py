@@ -100,6 +100,11 @@ class Lexer(object):
 		self._col = 1
 
 		self._next_token = None
+		self._token_count = 0
+
+	@property
+	def token_count(self):
+		return self._token_count
 
 	def is_eof(self):
 		return self.peek_token() == None
@@ -114,6 +119,8 @@ class Lexer(object):
 			self._next_token = self._parse_token()
 		result = self._next_token
 		self._next_token = None
+		if result is not None:
+			self._token_count += 1
 		return result
 	
 	def _parse_token(self):
@@ -141,8 +148,9 @@ class Lexer(object):
 		elif peeked in symbols:
 			return self._token(self._pos(), symbols[peeked], self._get())\
 				.with_whitespace(pre_whitespace)
-		else:  # consume unknown stuff so naive consumption still causes exit
-			print("lexer stopped at:", self._get())
+		else:  # consume unknown stuff so the parser can report it and move on
+			return self._token(self._pos(), TokenType.UNKNOWN, self._get())\
+				.with_whitespace(pre_whitespace)
 
 	def _parse_string(self, pre_whitespace):
 		pos = self._pos()
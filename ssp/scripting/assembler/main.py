@@ -2,8 +2,10 @@
 
 
 from ssp.scripting.assembler import Assembler
+from ssp.scripting.assembler.profile import AssemblerProfiler
 from ssp.scripting.source import FileSource
 import argparse
+import io
 import sys
 import os
 
@@ -33,13 +35,31 @@ def main():
 		print("input path: ", args.input)
 		print("output path:", args.output)
 
+	profiler = None
+	if args.profile or args.profile_json is not None:
+		profiler = AssemblerProfiler()
+
 	source = FileSource(input_file, args.input)
-	assembler = Assembler(verbose=args.verbose)
+	assembler = Assembler(verbose=args.verbose, profiler=profiler)
 	if not args.disasm:
 		messages = assembler.assemble(source, output_file)
 	else:
 		messages = assembler.disassemble(input_file, output_file)
 
+	if profiler is not None and not args.disasm:
+		if profiler.trace_memory:
+			# memory is measured in a second run, so tracing doesn't skew the times
+			input_file.seek(0)
+			with profiler.tracing():
+				Assembler(profiler=profiler).assemble(
+					FileSource(input_file, args.input), io.BytesIO()
+				)
+		if args.profile:
+			print(profiler.report())
+		if args.profile_json is not None:
+			with open(args.profile_json, 'w', encoding='utf8') as profile_file:
+				profiler.dump_json(profile_file)
+
 	exit_code = 0
 
 	if messages is not None and len(messages) > 0:
@@ -73,6 +93,14 @@ def get_args():
 		'-v', '--verbose', action='count', default=0,
 		help='enables verbose output'
 	)
+	parser.add_argument(
+		'--profile', action='store_true',
+		help='reports time, retained and peak memory for each assembler phase'
+	)
+	parser.add_argument(
+		'--profile-json', metavar='PATH',
+		help='writes the profiling report as JSON to the given path'
+	)
 	return parser.parse_args()
 
 
@@ -1,9 +1,12 @@
 
 
 from ..instruction import Instruction
+from ..data import INT_MIN, INT_MAX
 from .lexer import TokenType
 from ..opcode import Opcode
 
+from collections import namedtuple
+
 
 class NodeType:
 	IDENTIFIER = 0
@@ -47,26 +50,31 @@ class Node(object):
 		return self
 
 	def collapse_to_value(self, lookup_table={}):
-		simple_nodes = (
-			NodeType.INT_LITERAL,
-			NodeType.REAL_LITERAL,
-			NodeType.STR_LITERAL,
-		)
-		if self.type in simple_nodes:
+		if self.type in SIMPLE_NODE_TYPES:
 			return self.value
-		elif self.type == NodeType.LIST_LITERAL:
-			return [
-				x.collapse_to_value()
-				for x in self.value
-			]
-		elif self.type == NodeType.DICT_LITERAL:
-			return dict([
-				(key.collapse_to_value(), value.collapse_to_value())
-				for key, value in self.value.items()
-			])
 		elif self.type == NodeType.IDENTIFIER:
 			return lookup_table[self.value].collapse_to_value()
 
+		# containers are collapsed with an explicit stack rather than recursion
+		# so that arbitrarily deeply nested literals can be handled, children
+		# that are containers are inserted empty and filled in when popped
+		result = _empty_container(self.type)
+		stack = [(self, result)]
+		while stack:
+			node, container = stack.pop()
+			if node.type == NodeType.LIST_LITERAL:
+				for child in node.value:
+					container.append(_collapse_child(child, lookup_table, stack))
+			else:
+				for key, child in node.value.items():
+					container[key.collapse_to_value()] = _collapse_child(
+						child, lookup_table, stack
+					)
+		return result
+
+	def inline_value(self):
+		return self.collapse_to_value()
+
 	def pretty_str(self, indent=0, tabsize=2, separator='\n', prefix=""):
 		type_name = NodeType.to_string(self.type)
 
@@ -102,101 +110,273 @@ class Node(object):
 		return self.pretty_str()
 
 
+class DataNode(Node):
+	"""
+	Stands in for a literal that has been moved into the data section, it keeps
+	the literal's type for type checking but collapses to a data reference.
+	"""
+
+	def __init__(self, node_type, ref, constant):
+		super().__init__(node_type, ref)
+		self._constant = constant
+
+	def collapse_to_value(self, lookup_table={}):
+		return self.value
+
+	def inline_value(self):
+		return self._constant
+
+	def pretty_str(self, indent=0, tabsize=2, separator='\n', prefix=""):
+		return "{}{}{} ({})".format(
+			" " * (indent * tabsize), prefix,
+			NodeType.to_string(self.type).replace("_", " ").title(),
+			self.value.label
+		)
+
+
+class ParseError(namedtuple('ParseError', 'line col message')):
+
+	def __str__(self):
+		return "[{}:{}]: {}".format(self.line, self.col, self.message)
+
+
+class _Frame(object):
+	"""
+	A list or dictionary literal that is still being parsed.
+	"""
+
+	__slots__ = ('node_type', 'values', 'key', 'token', 'empty')
+
+	def __init__(self, node_type, token):
+		self.node_type = node_type
+		self.values = _empty_container(node_type)
+		self.key = None
+		self.token = token
+		self.empty = True
+
+	def add(self, node):
+		if self.node_type == NodeType.LIST_LITERAL:
+			self.values.append(node)
+		else:
+			self.values[self.key] = node
+			self.key = None
+		self.empty = False
+
+	def close(self):
+		return Node(self.node_type, self.values).at(*self.token.pos)
+
+
 class Parser(object):
+	"""
+	Parses instructions from a lexer's tokens.
+
+	Nested list and dictionary literals are parsed using an explicit stack,
+	so nesting depth is not limited by the recursion limit, but it is limited
+	to MAX_NESTING so that the output can still be encoded. Syntax errors are
+	collected rather than printed, and the parser skips past the offending
+	literal and the rest of its line and carries on so that every error in a
+	source can be reported at once.
+	"""
+
+	# msgpack refuses to encode values nested much deeper than this
+	MAX_NESTING = 256
 
 	def __init__(self, lexer):
 		self._lexer = lexer
+		self._errors = []
+		self._last_line = 1
+
+	@property
+	def errors(self):
+		return self._errors
+
+	def pop_errors(self):
+		errors, self._errors = self._errors, []
+		return errors
 
 	def parse_instruction(self):
-		operation = self._lexer.get_token()
-
-		if operation is None:
-			return None
-		if operation.type != TokenType.IDENTIFIER:
-			print("expected identifier at", operation.pos)
-			return None
-
-		opcode = Node(NodeType.IDENTIFIER, operation.value)
-		parameters = []
-		while not self._lexer.is_eof() and\
-				self._lexer.peek_token().line == operation.line:
-			parameter_token = self._lexer.get_token()
-			parameters.append(self._parse_value(parameter_token))
-
-		return Instruction(opcode, parameters).at(operation.line, operation.col)
-
-	def _parse_value(self, token):
-		mapping = [
-			((TokenType.IDENTIFIER,),
-				lambda token: Node(NodeType.IDENTIFIER, token.value)),
-			((TokenType.INTEGER, TokenType.REAL, TokenType.STRING,),
-				lambda token: self._parse_simple_literal(token)),
-			((TokenType.START_LIST,),
-				lambda token: self._parse_list()),
-			((TokenType.START_DICT,),
-				lambda token: self._parse_dict()),
-		]
-
-		result = None
-		for types, handler in mapping:
-			if token.type in types:
+		while True:
+			operation = self._next()
+
+			if operation is None:
+				return None
+			if operation.type != TokenType.IDENTIFIER:
+				self._syntax_error(operation, "expected identifier, got {}".format(
+					TokenType.to_string(operation.type)
+				))
+				self._skip_line()
+				continue
+
+			opcode = Node(NodeType.IDENTIFIER, operation.value)\
+				.at(*operation.pos)
+			parameters = []
+			while parameters is not None and self._on_line(operation.line):
+				parameter = self._parse_value()
+				if parameter is None:
+					parameters = None
+				else:
+					parameters.append(parameter)
+
+			if parameters is not None:
+				return Instruction(opcode, parameters)\
+					.at(operation.line, operation.col)
+
+	def _parse_value(self):
+		stack = []
+
+		while True:
+			# start of a value: either a simple value or a new container
+			token = self._lexer.peek_token()
+			if token is None:
+				return self._fail(token, "unexpected end of file, expected value", len(stack))
+
+			opener = Parser.CONTAINERS.get(token.type, None)
+			if opener is not None:
+				if len(stack) >= Parser.MAX_NESTING:
+					return self._fail(token, "literal nested too deeply (max: {})".format(
+						Parser.MAX_NESTING
+					), len(stack))
+				stack.append(_Frame(opener, self._next()))
+				node = None
+			else:
+				handler = Parser.VALUE_NODES.get(token.type, None)
 				if handler is None:
-					print("don't know what to do with {} types yet".format(
+					return self._fail(token, "expected value, got {}".format(
 						TokenType.to_string(token.type)
-					))
-				else:
-					result = handler(token)
-				break
-		return result
+					), len(stack))
+				self._next()
+				if handler == NodeType.INT_LITERAL and not (INT_MIN <= token.value <= INT_MAX):
+					return self._fail(token, "integer literal out of range ({} to {})".format(
+						INT_MIN, INT_MAX
+					), len(stack))
+				node = Node(handler, token.value).at(*token.pos)
 
-	def _parse_simple_literal(self, token):
-		node_type = {
-			TokenType.INTEGER: NodeType.INT_LITERAL,
-			TokenType.REAL: NodeType.REAL_LITERAL,
-			TokenType.STRING: NodeType.STR_LITERAL,
-		}[token.type]
-		return Node(node_type, token.value)
-	
-	def _parse_list(self):
-		values = []
-		first = True
-		while self._lexer.peek_token() and self._lexer.peek_token().type != TokenType.END_LIST:
-			if not first:
-				comma = self._lexer.get_token()
-				if comma.type != TokenType.COMMA:
-					print("expected comma at", comma.pos)
-					break
-			value = self._parse_value(self._lexer.get_token())
-			values.append(value)
-			first = False
-		end_token = self._lexer.get_token()
-		if end_token.type != TokenType.END_LIST:
-			print("expected end of list at", end_token.pos)
-		return Node(NodeType.LIST_LITERAL, values)
-
-	def _parse_dict(self):
-		values = {}
-		first = True
-		while self._lexer.peek_token().type != TokenType.END_DICT:
-			if not first:
-				comma = self._lexer.get_token()
-				if comma.type != TokenType.COMMA:
-					print("expected comma at", comma.pos)
-					break
-			key_token = self._lexer.get_token()
-			if key_token.type != TokenType.STRING:
-				print("expected key token at", key_token.pos)
-				break
-			colon = self._lexer.get_token()
-			if colon.type != TokenType.COLON:
-				print("expected colon at", colon.pos)
+			# pass completed values up through their containers until one of
+			# them wants another value (or the outermost value is complete)
+			while True:
+				if len(stack) == 0:
+					return node
+
+				frame = stack[-1]
+				if node is not None:
+					frame.add(node)
+					node = None
+
+				token = self._lexer.peek_token()
+				closer = Parser.CLOSERS[frame.node_type]
+				if token is not None and token.type == closer:
+					self._next()
+					node = stack.pop().close()
+					continue
+
+				if not frame.empty:
+					if token is None or token.type != TokenType.COMMA:
+						return self._fail(token, "expected comma or {}".format(
+							TokenType.to_string(closer)
+						), len(stack))
+					self._next()
+
+				if frame.node_type == NodeType.DICT_LITERAL:
+					if not self._parse_key(frame, len(stack)):
+						return None
 				break
-			key = Node(NodeType.STR_LITERAL, key_token.value)
-			value = self._parse_value(self._lexer.get_token())
-			values[key] = value
-			first = False
-		end_token = self._lexer.get_token()
-		if end_token.type != TokenType.END_DICT:
-			print("expected end of dictionary at", end_token.pos)
-		return Node(NodeType.DICT_LITERAL, values)
 
+	def _parse_key(self, frame, depth):
+		key_token = self._lexer.peek_token()
+		if key_token is None or key_token.type != TokenType.STRING:
+			self._fail(key_token, "expected dictionary key", depth)
+			return False
+		self._next()
+
+		colon = self._lexer.peek_token()
+		if colon is None or colon.type != TokenType.COLON:
+			self._fail(colon, "expected colon", depth)
+			return False
+		self._next()
+
+		frame.key = Node(NodeType.STR_LITERAL, key_token.value)\
+			.at(*key_token.pos)
+		return True
+
+	def _next(self):
+		token = self._lexer.get_token()
+		if token is not None:
+			self._last_line = token.line
+		return token
+
+	def _on_line(self, line):
+		token = self._lexer.peek_token()
+		return token is not None and token.line == line
+
+	def _skip_line(self):
+		while self._on_line(self._last_line):
+			self._next()
+
+	def _skip_literal(self, depth):
+		# discards tokens up to and including the end of the outermost of the
+		# depth literals still open
+		while depth > 0:
+			token = self._next()
+			if token is None:
+				return
+			if token.type in Parser.CONTAINERS:
+				depth += 1
+			elif token.type in Parser.CLOSERS.values():
+				depth -= 1
+
+	def _fail(self, token, message, depth=0):
+		self._syntax_error(token, message)
+		# skip past the literal the error is in, which may span lines, then
+		# discard what remains of the line it ends on: a token on a later
+		# line is most likely the start of the next instruction
+		self._skip_literal(depth)
+		self._skip_line()
+		return None
+
+	def _syntax_error(self, token, message):
+		if token is not None:
+			line, col = token.pos
+		else:
+			line, col = self._last_line, 0
+		self._errors.append(ParseError(line, col, message))
+
+	VALUE_NODES = {
+		TokenType.IDENTIFIER: NodeType.IDENTIFIER,
+		TokenType.INTEGER: NodeType.INT_LITERAL,
+		TokenType.REAL: NodeType.REAL_LITERAL,
+		TokenType.STRING: NodeType.STR_LITERAL,
+	}
+
+	CONTAINERS = {
+		TokenType.START_LIST: NodeType.LIST_LITERAL,
+		TokenType.START_DICT: NodeType.DICT_LITERAL,
+	}
+
+	CLOSERS = {
+		NodeType.LIST_LITERAL: TokenType.END_LIST,
+		NodeType.DICT_LITERAL: TokenType.END_DICT,
+	}
+
+
+SIMPLE_NODE_TYPES = (
+	NodeType.INT_LITERAL,
+	NodeType.REAL_LITERAL,
+	NodeType.STR_LITERAL,
+)
+
+
+def _empty_container(node_type):
+	if node_type == NodeType.LIST_LITERAL:
+		return []
+	return {}
+
+
+def _collapse_child(child, lookup_table, stack):
+	if child.type in (NodeType.LIST_LITERAL, NodeType.DICT_LITERAL):
+		container = _empty_container(child.type)
+		stack.append((child, container))
+		return container
+	elif child.type == NodeType.IDENTIFIER:
+		# data section references can't be nested, so those are inlined
+		return lookup_table[child.value].inline_value()
+	return child.collapse_to_value(lookup_table)
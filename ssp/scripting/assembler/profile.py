@@ -0,0 +1,161 @@
+
+from collections import OrderedDict, namedtuple
+import contextlib
+import tracemalloc
+import time
+import json
+
+
+class PhaseStats(namedtuple('PhaseStats', 'name wall_time retained_blocks retained_memory peak_memory')):
+
+	def to_dict(self):
+		return OrderedDict([
+			('name', self.name),
+			('wall_time', self.wall_time),
+			('retained_blocks', self.retained_blocks),
+			('retained_memory', self.retained_memory),
+			('peak_memory', self.peak_memory),
+		])
+
+
+class AssemblerProfiler(object):
+	"""
+	Records wall time and memory use for each assembler phase, as well as
+	counters (tokens, instructions, labels) for computing rates.
+
+	tracemalloc slows everything down several times over, so wall times and
+	counters come from a normal run and memory figures from a second run of
+	the same assembly inside tracing(). Memory figures are the peak traced
+	memory above what was allocated when the phase started, and the blocks
+	and bytes allocated by the phase that were still alive when it ended.
+	"""
+
+	RATE_COUNTERS = ('tokens', 'instructions', 'labels')
+
+	def __init__(self, trace_memory=True):
+		self._trace_memory = trace_memory
+		self._tracing = False
+		self._phases = OrderedDict()
+		self._counters = OrderedDict()
+
+	@property
+	def trace_memory(self):
+		return self._trace_memory
+
+	@property
+	def phases(self):
+		return list(self._phases.values())
+
+	@property
+	def total_time(self):
+		return sum(phase.wall_time for phase in self._phases.values())
+
+	def count(self, counter, value):
+		# the traced run would count everything a second time
+		if self._tracing:
+			return
+		self._counters[counter] = self._counters.get(counter, 0) + value
+
+	def get_count(self, counter):
+		return self._counters.get(counter, 0)
+
+	def rate(self, counter):
+		total = self.total_time
+		if total <= 0:
+			return None
+		return self.get_count(counter) / total
+
+	@contextlib.contextmanager
+	def tracing(self):
+		"""
+		Phases run inside this record memory use instead of wall time.
+		"""
+		started_tracing = not tracemalloc.is_tracing()
+		if started_tracing:
+			tracemalloc.start()
+		self._tracing = True
+		try:
+			yield
+		finally:
+			self._tracing = False
+			if started_tracing:
+				tracemalloc.stop()
+
+	@contextlib.contextmanager
+	def phase(self, name):
+		if self._tracing:
+			with self._traced_phase(name):
+				yield
+			return
+
+		start = time.perf_counter()
+		try:
+			yield
+		finally:
+			wall_time = time.perf_counter() - start
+			self._phases[name] = PhaseStats(name, wall_time, None, None, None)
+
+	@contextlib.contextmanager
+	def _traced_phase(self, name):
+		before = tracemalloc.take_snapshot()
+		tracemalloc.reset_peak()
+		baseline = tracemalloc.get_traced_memory()[0]
+		try:
+			yield
+		finally:
+			peak_memory = tracemalloc.get_traced_memory()[1] - baseline
+			after = tracemalloc.take_snapshot()
+			grown = [
+				stat for stat in after.compare_to(before, 'filename')
+				if stat.size_diff > 0
+			]
+			retained_blocks = sum(max(stat.count_diff, 0) for stat in grown)
+			retained_memory = sum(stat.size_diff for stat in grown)
+
+			stats = self._phases.get(name, None)
+			wall_time = stats.wall_time if stats is not None else 0.0
+			self._phases[name] = PhaseStats(
+				name, wall_time, retained_blocks, retained_memory, peak_memory
+			)
+
+	def to_dict(self):
+		return OrderedDict([
+			('phases', [phase.to_dict() for phase in self._phases.values()]),
+			('total_time', self.total_time),
+			('counters', OrderedDict(self._counters)),
+			('rates', OrderedDict([
+				(counter, self.rate(counter))
+				for counter in AssemblerProfiler.RATE_COUNTERS
+			])),
+		])
+
+	def dump_json(self, output):
+		json.dump(self.to_dict(), output, indent=4)
+		output.write("\n")
+
+	def report(self):
+		kib = lambda x: "{:.1f}".format(x / 1024.0)
+		lines = ["{:<24} {:>12} {:>16} {:>16} {:>12}".format(
+			"phase", "wall (ms)", "retained blocks", "retained (KiB)", "peak (KiB)"
+		)]
+		for phase in self._phases.values():
+			lines.append("{:<24} {:>12.3f} {:>16} {:>16} {:>12}".format(
+				phase.name, phase.wall_time * 1000.0,
+				_or_dash(phase.retained_blocks),
+				_or_dash(phase.retained_memory, kib),
+				_or_dash(phase.peak_memory, kib)
+			))
+		lines.append("{:<24} {:>12.3f}".format("total", self.total_time * 1000.0))
+
+		for counter in AssemblerProfiler.RATE_COUNTERS:
+			lines.append("{}: {} ({} per second)".format(
+				counter, self.get_count(counter),
+				_or_dash(self.rate(counter), lambda x: "{:.1f}".format(x))
+			))
+		return "\n".join(lines)
+
+
+def _or_dash(value, formatter=str):
+	if value is None:
+		return "-"
+	return formatter(value)
@@ -0,0 +1,126 @@
+
+from .instruction import Instruction
+import msgpack
+
+
+# msgpack extension type code used to encode references into the data section
+DATA_REF_EXT = 1
+
+# record written in place of an opcode to mark the start of the data section
+DATA_SECTION_MARKER = None
+
+# range of integers msgpack can encode
+INT_MIN = -(1 << 63)
+INT_MAX = (1 << 64) - 1
+
+# largest packed size of a single constant in the data section, in bytes
+MAX_DATA_SIZE = 1 << 20
+
+
+class DataRef(object):
+	"""
+	A reference from an instruction parameter to a constant in the data section.
+	"""
+
+	__slots__ = ('_index',)
+
+	def __init__(self, index):
+		self._index = index
+
+	@property
+	def index(self):
+		return self._index
+
+	@property
+	def label(self):
+		# assembler identifiers can't contain digits, so spell the index out
+		# in letters instead (0 -> a, 25 -> z, 26 -> ba, ...)
+		letters = ''
+		index = self._index
+		while True:
+			letters = chr(ord('a') + index % 26) + letters
+			index //= 26
+			if index == 0:
+				break
+		return "data_{}".format(letters)
+
+	def __eq__(self, other):
+		return isinstance(other, DataRef) and other.index == self.index
+
+	def __hash__(self):
+		return hash((DataRef, self._index))
+
+	def __repr__(self):
+		return "DataRef({})".format(self._index)
+
+
+class DataSection(object):
+	"""
+	Constants stored out-of-line from the instructions, each kept as packed
+	bytes until it is requested. Lists and maps can be changed in place by
+	the program, so every request for one decodes a separate copy; other
+	values are decoded once and shared.
+	"""
+
+	def __init__(self, blobs=None):
+		self._blobs = list(blobs) if blobs is not None else []
+		self._values = {}
+
+	def __len__(self):
+		return len(self._blobs)
+
+	def __getitem__(self, index):
+		try:
+			return self._values[index]
+		except KeyError:
+			pass
+		value = msgpack.unpackb(self._blobs[index], encoding='utf8')
+		if not isinstance(value, (list, dict)):
+			self._values[index] = value
+		return value
+
+	def resolve(self, parameters):
+		return [
+			self[param.index] if isinstance(param, DataRef) else param
+			for param in parameters
+		]
+
+
+def pack_default(obj):
+	if isinstance(obj, DataRef):
+		return msgpack.ExtType(DATA_REF_EXT, msgpack.packb(obj.index))
+	raise TypeError("cannot serialise {}".format(repr(obj)))
+
+
+def unpack_ext_hook(code, data):
+	if code == DATA_REF_EXT:
+		return DataRef(msgpack.unpackb(data))
+	return msgpack.ExtType(code, data)
+
+
+def read_program(filehandle):
+	"""
+	Reads a binary into a list of instructions and its data section, leaving
+	any data references in instruction parameters unresolved.
+	"""
+	unpacker = msgpack.Unpacker(
+		filehandle, encoding='utf8', ext_hook=unpack_ext_hook
+	)
+	program = []
+	data = DataSection()
+
+	while True:
+		try:
+			inst = Instruction.from_unpacker(unpacker)
+		except msgpack.OutOfData:
+			break
+		if inst.opcode == DATA_SECTION_MARKER:
+			data = DataSection(inst.parameters)
+			break
+		program.append(inst)
+
+	return program, data
+
+
+def has_data_refs(inst):
+	return any(isinstance(param, DataRef) for param in inst.parameters)
@@ -2,20 +2,18 @@ import logging
 
 from ..opcode import Opcode
 from ..instruction import Instruction
-
-import msgpack
+from ..data import read_program, has_data_refs
 
 
 def load_program(filehandle):
-    unpacker = msgpack.Unpacker(filehandle, encoding='utf8')
-    program = []
+    program, data = read_program(filehandle)
 
-    while True:
-        try:
-            inst = Instruction.from_unpacker(unpacker)
-        except msgpack.OutOfData:
-            break
-        program.append(inst)
+    # constants in the data section are only decoded once an instruction
+    # referencing them is first executed
+    if len(data) > 0:
+        for inst in program:
+            if has_data_refs(inst):
+                inst.bind_data(data)
 
     return program
 
@@ -47,6 +45,9 @@ class BlockingReason:
     SEND_RESP = 0
     RECV = 1
     LISTEN = 2
+    SLEEP = 3
+    # held by the host until a message it sent fits in the receiver's mailbox
+    SEND_FULL = 4
 
     @classmethod
     def from_string(cls, string):
@@ -54,6 +55,8 @@ class BlockingReason:
             'SEND_RESP': cls.SEND_RESP,
             'RECV': cls.RECV,
             'LISTEN': cls.LISTEN,
+            'SLEEP': cls.SLEEP,
+            'SEND_FULL': cls.SEND_FULL,
         }[string.upper()]
 
     @classmethod
@@ -62,6 +65,8 @@ class BlockingReason:
             cls.SEND_RESP: 'SEND_RESP',
             cls.RECV: 'RECV',
             cls.LISTEN: 'LISTEN',
+            cls.SLEEP: 'SLEEP',
+            cls.SEND_FULL: 'SEND_FULL',
         }[integer]
 
 
@@ -74,7 +79,8 @@ class Emulator(object):
         self._inst_ptr = boot_addr
         self._boot_addr = boot_addr
         self._state = EmulatorState.HALTED
-        self._block_reason = None
+        self._blocking_reason = None
+        self._block_timeout = None
         self._verbose = verbose
         self._cycles = 0
 
@@ -116,8 +122,16 @@ class Emulator(object):
             self._on_resume(self)
     
         self._blocking_reason = None
+        self._block_timeout = None
         self._state = EmulatorState.RUNNING
 
+    def hold_send(self):
+        """
+        Blocks the emulator in SEND_FULL until the host resumes it, for when
+        a message it sent is waiting for room in the receiver's mailbox.
+        """
+        self._block(BlockingReason.SEND_FULL)
+
     def receive(self, sender, values):
         receive_reasons = (
             BlockingReason.SEND_RESP,
@@ -142,6 +156,17 @@ class Emulator(object):
 
         self.resume()
 
+    def receive_timeout(self):
+        if self._blocking_reason != BlockingReason.RECV:
+            return
+
+        self.logger.debug("receive timed out")
+        # same shape as a received message, with null values and sender
+        self._push(None)
+        self._push(None)
+
+        self.resume()
+
     def halt(self):
         if not self.halted:
             self._state = EmulatorState.HALTED
@@ -162,11 +187,56 @@ class Emulator(object):
 
     @property
     def blocking_reason(self):
-        return self._block_reason
+        return self._blocking_reason
+
+    @property
+    def block_timeout(self):
+        """
+        Milliseconds the current block (SLEEP, or RECV from RECVT) should
+        last before the host wakes the emulator, None for no limit.
+        """
+        return self._block_timeout
+
+    def get_state(self, include_program=True):
+        """
+        Everything needed to recreate this emulator with set_state, using
+        only values that can be serialised with msgpack. A state without the
+        program has to be merged back into one with it before it's set.
+        """
+        state = {
+            'stack': self._stack,
+            'inst_ptr': self._inst_ptr,
+            'boot_addr': self._boot_addr,
+            'state': self._state,
+            'blocking_reason': self._blocking_reason,
+            'block_timeout': self._block_timeout,
+            'cycles': self._cycles,
+        }
+        if include_program:
+            state['program'] = [
+                [inst.opcode, inst.parameters]
+                for inst in self._program
+            ]
+        return state
+
+    def set_state(self, state):
+        # hooks aren't called, the emulator is put straight into the state
+        self._program = [
+            Instruction(opcode, parameters)
+            for opcode, parameters in state['program']
+        ]
+        self._stack = state['stack']
+        self._inst_ptr = state['inst_ptr']
+        self._boot_addr = state['boot_addr']
+        self._state = state['state']
+        self._blocking_reason = state['blocking_reason']
+        self._block_timeout = state['block_timeout']
+        self._cycles = state['cycles']
 
     def reset(self):
         self.halt()
         self._blocking_reason = None
+        self._block_timeout = None
         self._stack.clear()
         self._inst_ptr = self._boot_addr
         self._cycles = 0
@@ -251,8 +321,9 @@ class Emulator(object):
         if self._on_send is not None:
             self._on_send(self, target, values)
     
-    def _block(self, reason):
+    def _block(self, reason, timeout=None):
         self._blocking_reason = reason
+        self._block_timeout = timeout
         self._state = EmulatorState.BLOCKED
         if self._on_block is not None:
             self._on_block(self, reason)
@@ -558,6 +629,28 @@ class Emulator(object):
         emu._block(BlockingReason.LISTEN)
         emu._advance_inst()
 
+    @staticmethod
+    def _inst_timed_block(emu, inst, reason):
+        if len(inst.parameters) == 0:
+            duration = emu._pop()
+            if duration is None: return
+        elif len(inst.parameters) == 1:
+            duration = inst.parameters[0]
+        else:
+            emu.trigger_error("{} expects zero or one duration parameters".format(
+                Opcode.to_string(inst.opcode).lower()
+            ))
+            return
+
+        if isinstance(duration, bool) or not isinstance(duration, (int, float)) or duration < 0:
+            emu.trigger_error("{} duration must be a non-negative number of milliseconds".format(
+                Opcode.to_string(inst.opcode).lower()
+            ))
+            return
+
+        emu._block(reason, duration)
+        emu._advance_inst()
+
     @staticmethod
     def _inst_zero(emu, inst):
         top = emu._pop()
@@ -686,5 +779,7 @@ class InstructionSet:
         Opcode.JI: (Emulator._inst_ji,),
         Opcode.JN: (Emulator._inst_jn,),
         Opcode.JMP: (Emulator._inst_jmp,),
+        Opcode.SLEEP: (Emulator._inst_timed_block, BlockingReason.SLEEP),
+        Opcode.RECVT: (Emulator._inst_timed_block, BlockingReason.RECV),
     }
 
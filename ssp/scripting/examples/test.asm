@@ -152,7 +152,29 @@ append
 send			# pops the value from top of stack, identifies that target is a remote machine and sends popped values to that remote machine
 pop 1 			# clear send result
 
+# example of waiting for time to pass:
+
+sleep 250		# blocks for (at least) 250 milliseconds without using any cycles
+push 100
+sleep			# duration can come from the stack too
+
+# example of receiving with a timeout:
+
+recvt 1000		# like recv, but if nothing arrives within 1000 milliseconds both the values and sender are null
+pop 2
+
 # example of receiving from another process:
 
 recv
 
+
+# example of a constant kept in the data section:
+
+# large literals can be given a name with "data", they are stored once in a
+# separate section of the binary (identical constants are stored once) and
+# are only decoded when an instruction using them first runs
+data primes [2, 3, 5, 7, 11, 13, 17, 19, 23, 29]
+
+push primes
+lookup 4
+pop 1
@@ -9,6 +9,7 @@ class Instruction(object):
 	def __init__(self, opcode, parameters):
 		self._opcode = opcode
 		self._parameters = parameters
+		self._data = None
 
 		self._line = 1
 		self._col = 1
@@ -19,6 +20,13 @@ class Instruction(object):
 
 	@property
 	def parameters(self):
+		if self._data is not None:
+			self._parameters = self._data.resolve(self._parameters)
+			self._data = None
+		return self._parameters
+
+	@property
+	def raw_parameters(self):
 		return self._parameters
 
 	@property
@@ -34,15 +42,21 @@ class Instruction(object):
 		self._col = col
 		return self
 
+	def bind_data(self, data):
+		self._data = data
+		return self
+
 	def pretty_string(self):
 		opcode_str = Opcode.to_string(self._opcode)
 		if opcode_str is None:
 			opcode_str = "unknown_opcode_0x{:02X}".format(self._opcode)
 		tokens = [opcode_str]
 
-		for index, param in enumerate(self.parameters):
-			last = index == len(self.parameters) - 1
-			if not last:
+		for index, param in enumerate(self.raw_parameters):
+			last = index == len(self.raw_parameters) - 1
+			if hasattr(param, 'label'):
+				param_str = param.label
+			elif not last:
 				param_str = json.dumps(param)
 			else:
 				param_str = json.dumps(param, indent=4)
@@ -52,8 +66,8 @@ class Instruction(object):
 
 	def __str__(self):
 		result = "{} ({})".format(Opcode.to_string(self._opcode), self._opcode)
-		if len(self._parameters) > 0:
-			result += ": " + " ".join(map(str, self._parameters))
+		if len(self.parameters) > 0:
+			result += ": " + " ".join(map(str, self.parameters))
 		return result
 
 	@staticmethod
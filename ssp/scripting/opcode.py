@@ -26,6 +26,8 @@ class Opcode:
     JI = 22
     JN = 23
     JMP = 24
+    SLEEP = 25
+    RECVT = 26
 
     @classmethod
     def from_string(cls, string):
@@ -55,6 +57,8 @@ class Opcode:
             'JI': cls.JI,
             'JN': cls.JN,
             'JMP': cls.JMP,
+            'SLEEP': cls.SLEEP,
+            'RECVT': cls.RECVT,
         }.get(string.upper(), None)
 
     @classmethod
@@ -85,5 +89,7 @@ class Opcode:
             cls.JI: 'JI',
             cls.JN: 'JN',
             cls.JMP: 'JMP',
+            cls.SLEEP: 'SLEEP',
+            cls.RECVT: 'RECVT',
         }.get(integer, None)
 
@@ -1,21 +1,68 @@
 import asyncio
 import argparse
+import concurrent.futures
 import logging
+import os
 import sys
 
 import ssp.logging
 import ssp.scripting.emulator
 
 from . import Server, Universe
+from .universe.store import MachineStore
+from .universe.persistence import Persistence
+from .universe.tracing import IpcTracer
 from .net import h2
 
 logger = logging.getLogger(__name__)
 
+def positive_float(value):
+    try:
+        value = float(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError('invalid float value: {!r}'.format(value))
+    if not value > 0:
+        raise argparse.ArgumentTypeError('must be positive: {}'.format(value))
+    return value
+
 def main(args=None):
     parser = argparse.ArgumentParser(description='Run an SSP server')
     parser.add_argument('--bind', '-b', default='127.0.0.1')
     parser.add_argument('--port', '-p', type=int, default=8443)
     parser.add_argument('--network-logging')
+    parser.add_argument('--tick-rate', type=positive_float, default=Server.TICK_RATE,
+        help='ticks per second')
+    parser.add_argument('--catch-up', choices=Server.CATCH_UP_POLICIES, default=Server.CATCH_UP_SKIP,
+        help='whether ticks missed while the server was busy are skipped or run late')
+    parser.add_argument('--max-catch-up', type=int, default=Server.MAX_CATCH_UP,
+        help='most missed ticks run back to back when catching up')
+    parser.add_argument('--off-loop-ticks', action='store_true',
+        help='run universe ticks on a worker thread so requests are served during ticks')
+    parser.add_argument('--tick-budget', type=float, default=50,
+        help='milliseconds the universe may spend running processes per tick')
+    parser.add_argument('--hibernate-dir',
+        help='directory idle machines are saved to while hibernating')
+    parser.add_argument('--hibernate-after', type=float, default=600,
+        help='seconds a machine must go unaccessed before it is hibernated, if --hibernate-dir is given')
+    parser.add_argument('--persist-dir',
+        help='directory the universe is saved to and restored from on start')
+    parser.add_argument('--log-interval', type=float, default=1,
+        help='seconds between writes of changed machines to the write-ahead log')
+    parser.add_argument('--snapshot-interval', type=float, default=300,
+        help='seconds between full snapshots of the universe')
+    parser.add_argument('--fsync', action='store_true',
+        help='fsync the snapshot and log after every write')
+    parser.add_argument('--process-pool', type=int, default=64,
+        help='number of pre-built emulator processes kept for starting processes')
+    parser.add_argument('--turbo', action='store_true',
+        help='run ticks back to back as fast as possible instead of at the tick rate')
+    parser.add_argument('--turbo-ticks', type=int,
+        help='stop after this many ticks when running in turbo mode')
+    parser.add_argument('--trace-ipc', type=int, metavar='N',
+        help='trace every Nth message sent by processes, for IPC latency stats at /server/ipc')
+    parser.add_argument('--admin-secret', default=os.environ.get('SSP_ADMIN_SECRET'),
+        help='key that admin requests (e.g. /machines/bulk) are signed with, as machine "admin" '
+            '(default $SSP_ADMIN_SECRET), admin requests are refused without one')
     args = parser.parse_args(args)
     
     handler = logging.StreamHandler(sys.stdout)
@@ -31,12 +78,35 @@ def main(args=None):
         rootLogger.setLevel(logging.DEBUG)
         
     loop = asyncio.get_event_loop()
-    universe = Universe()
-    server = Server(loop, universe)
+    store = None
+    if args.hibernate_dir is not None:
+        store = MachineStore(args.hibernate_dir)
+    universe = Universe(tick_budget=args.tick_budget / 1000.0,
+        store=store, hibernate_after=args.hibernate_after,
+        process_pool_size=args.process_pool)
+    if args.trace_ipc is not None:
+        IpcTracer(universe, sample_every=args.trace_ipc)
+    persistence = None
+    if args.persist_dir is not None:
+        log_every = max(1, int(round(args.log_interval * args.tick_rate)))
+        persistence = Persistence(universe, args.persist_dir,
+            log_every=log_every,
+            snapshot_every=max(1, int(round(args.snapshot_interval / args.log_interval))),
+            sync=args.fsync)
+        persistence.restore()
+    tick_executor = None
+    if args.off_loop_ticks:
+        tick_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    server = Server(loop, universe, tick_rate=args.tick_rate,
+        catch_up=args.catch_up, max_catch_up=args.max_catch_up,
+        tick_executor=tick_executor, turbo=args.turbo, max_ticks=args.turbo_ticks,
+        admin_secret=args.admin_secret)
 
     logger.info('Starting server')
 
     server.start()
+    if args.turbo:
+        server.wait_finished().add_done_callback(lambda _: loop.stop())
     coro = loop.create_task(h2.start_server(server, host=args.bind, port=args.port))
     h2_server = loop.run_until_complete(coro)
 
@@ -54,5 +124,14 @@ def main(args=None):
     loop.run_until_complete(server.wait_finished())
     loop.close()
 
+    if server.report is not None:
+        logger.info('Turbo run: {}'.format(server.report))
+
+    if persistence is not None:
+        persistence.close()
+
+    if tick_executor is not None:
+        tick_executor.shutdown()
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,138 @@
+import bisect
+import collections
+
+class Histogram(object):
+    """
+    Fixed-bucket histogram. Bucket bounds are inclusive upper limits, values
+    above the last bound are counted in an overflow bucket.
+    """
+
+    # seconds, roughly logarithmic from 100us to 10s
+    DEFAULT_BOUNDS = (
+        0.0001, 0.0002, 0.0005,
+        0.001, 0.002, 0.005,
+        0.01, 0.02, 0.05,
+        0.1, 0.2, 0.5,
+        1.0, 2.0, 5.0, 10.0,
+    )
+
+    def __init__(self, bounds=DEFAULT_BOUNDS):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = None
+
+    def record(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if (self.max is None) or (value > self.max):
+            self.max = value
+
+    @property
+    def mean(self):
+        if self.count == 0:
+            return None
+        return self.total / self.count
+
+    def percentile(self, fraction):
+        """
+        Upper bound of the bucket containing the given fraction of values
+        (the maximum seen, for the overflow bucket).
+        """
+        if self.count == 0:
+            return None
+        needed = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if (seen >= needed) and (count > 0):
+                if index < len(self.bounds):
+                    return self.bounds[index]
+                return self.max
+        return self.max
+
+    def reset(self):
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = None
+
+    def to_dict(self):
+        return collections.OrderedDict([
+            ('count', self.count),
+            ('mean', self.mean),
+            ('max', self.max),
+            ('p50', self.percentile(0.5)),
+            ('p90', self.percentile(0.9)),
+            ('p99', self.percentile(0.99)),
+            ('buckets', [
+                [bound, count]
+                for bound, count in zip(self.bounds + (None,), self.counts)
+            ]),
+        ])
+
+class TickMetrics(object):
+    """
+    Tick duration, lateness (how long after its deadline a tick started) and
+    overrun (how far a tick ran past the tick time) for a Server.
+    """
+
+    def __init__(self):
+        self.ticks = 0
+        self.overruns = 0
+        self.skipped = 0
+        self.caught_up = 0
+        self.duration = Histogram()
+        self.lateness = Histogram()
+        self.overrun = Histogram()
+
+    def to_dict(self):
+        return collections.OrderedDict([
+            ('ticks', self.ticks),
+            ('overruns', self.overruns),
+            ('skipped', self.skipped),
+            ('caught_up', self.caught_up),
+            ('duration', self.duration.to_dict()),
+            ('lateness', self.lateness.to_dict()),
+            ('overrun', self.overrun.to_dict()),
+        ])
+
+class ThroughputReport(object):
+    """
+    How fast a Server got through ticks and emulator instructions, for runs
+    that aren't paced by the tick rate.
+    """
+
+    def __init__(self, ticks, instructions, elapsed):
+        self.ticks = ticks
+        self.instructions = instructions
+        self.elapsed = elapsed
+
+    @property
+    def ticks_per_second(self):
+        if self.elapsed <= 0:
+            return None
+        return self.ticks / self.elapsed
+
+    @property
+    def instructions_per_second(self):
+        if self.elapsed <= 0:
+            return None
+        return self.instructions / self.elapsed
+
+    def to_dict(self):
+        return collections.OrderedDict([
+            ('ticks', self.ticks),
+            ('instructions', self.instructions),
+            ('elapsed', self.elapsed),
+            ('ticks_per_second', self.ticks_per_second),
+            ('instructions_per_second', self.instructions_per_second),
+        ])
+
+    def __str__(self):
+        return '{} ticks and {} instructions in {:.3f}s ({:.1f} ticks/s, {:.1f} instructions/s)'.format(
+            self.ticks, self.instructions, self.elapsed,
+            self.ticks_per_second or 0, self.instructions_per_second or 0
+        )
@@ -3,6 +3,7 @@ import aioh2
 import asyncio
 import collections
 import io
+import itertools
 import json
 import logging
 import re
@@ -91,17 +92,39 @@ def _verify_machine_auth(server, headers):
     machine = headers.get('machine')
     if machine is None:
         return None
-        
-    machine = server.universe.machines.get(machine)
-    if machine is None:
+
+    # hibernating machines are only woken once the request is known to be
+    # theirs
+    secret = server.universe.machine_secret(machine)
+    if secret is None:
         return None
 
-    mach_id = verify_machine_auth(headers, machine.id, machine.secret)
+    mach_id = verify_machine_auth(headers, machine, secret)
     if mach_id is None:
         return None
 
-    return machine
+    return server.universe.get_machine(mach_id)
         
+# admin requests are signed like machine requests, as this machine with the
+# server's admin secret
+ADMIN_ID = 'admin'
+
+def _verify_admin_auth(server, headers):
+    if (server.admin_secret is None) or (headers.get('machine') != ADMIN_ID):
+        return False
+    return verify_machine_auth(headers, ADMIN_ID, server.admin_secret) is not None
+
+async def server_verify_admin_auth(server, proto, stream_id, headers, fatal=True):
+    admin = _verify_admin_auth(server, headers)
+    if fatal and not admin:
+        await proto.send_headers(stream_id, (
+            (':status', '401'),
+            ('content-type', 'application/json'),
+        ))
+        await proto.send_data(stream_id, b'{}', end_stream=True)
+
+    return admin
+
 async def server_verify_machine_auth(server, proto, stream_id, headers, fatal=True, expected_id=None):
     machine = _verify_machine_auth(server, headers)
     if fatal and ((machine is None) or ((expected_id is not None) and (machine.id != expected_id))):
@@ -129,6 +152,63 @@ async def new_machine(server, proto, match, headers, stream_id):
     }).encode('utf-8')
     await proto.send_data(stream_id, payload, end_stream=True)
 
+# most machines created by one bulk request, and how many are sent per chunk
+# how many of the busiest processes /server/ticks reports the CPU share of
+CPU_SHARE_TOP = 20
+
+MAX_BULK_MACHINES = 10000
+BULK_CHUNK_SIZE = 500
+
+@post('/machines/bulk/?')
+async def new_machines(server, proto, match, headers, stream_id):
+    if not await server_verify_admin_auth(server, proto, stream_id, headers):
+        return
+
+    payload = await proto.read_stream(stream_id, -1)
+    try:
+        count = json.loads(payload.decode('utf-8')).get('count')
+    except (ValueError, AttributeError):
+        count = None
+
+    if isinstance(count, bool) or (not isinstance(count, int)) or (count < 1) or (count > MAX_BULK_MACHINES):
+        await proto.send_headers(stream_id, (
+            (':status', '400'),
+            ('content-type', 'application/json'),
+        ))
+        await proto.send_data(stream_id, json.dumps({
+            'success': False,
+            'error': 'count must be between 1 and {}'.format(MAX_BULK_MACHINES),
+        }).encode('utf-8'), end_stream=True)
+        return
+
+    await proto.send_headers(stream_id, (
+        (':status', '200'),
+        ('content-type', 'application/json'),
+    ))
+
+    # the response is one JSON document, sent a chunk of machines at a time
+    # so neither side holds the whole thing and ticks carry on in between
+    machines = server.universe.create_player_machines(count)
+    created = []
+    try:
+        await proto.send_data(stream_id, b'{"success": true, "machines": [')
+        separator = ''
+        for start in range(0, count, BULK_CHUNK_SIZE):
+            chunk = []
+            for mach in itertools.islice(machines, BULK_CHUNK_SIZE):
+                created.append(mach.id)
+                chunk.append(separator)
+                chunk.append(json.dumps({'id': mach.id, 'secret': mach.secret}))
+                separator = ', '
+            await proto.send_data(stream_id, ''.join(chunk).encode('utf-8'))
+        await proto.send_data(stream_id, b']}', end_stream=True)
+    except BaseException:
+        # nobody could use machines whose secrets never reached the client,
+        # and the client can't tell which did from half a document
+        for id in created:
+            server.universe.remove_machine(id)
+        raise
+
 @post('/machines/([^/]*)/start-process')
 async def machine_start_process(server, proto, match, headers, stream_id):
     mach = await server_verify_machine_auth(server, proto, stream_id, headers, expected_id=match.group(1))
@@ -167,6 +247,81 @@ async def machine_send(server, proto, match, headers, stream_id):
         'result': ret,
         }).encode('utf-8'), end_stream=True)
 
+@get('/machines/([^/]*)/mailboxes/?')
+async def machine_mailboxes(server, proto, match, headers, stream_id):
+    mach = await server_verify_machine_auth(server, proto, stream_id, headers, expected_id=match.group(1))
+    if mach is None:
+        return
+
+    await proto.send_headers(stream_id, (
+        (':status', '200'),
+        ('content-type', 'application/json'),
+    ))
+    payload = json.dumps(dict(
+        (str(pid), proc.mailbox.to_dict())
+        for pid, proc in list(mach.processes.items())
+        if hasattr(proc, 'mailbox')
+    )).encode('utf-8')
+    await proto.send_data(stream_id, payload, end_stream=True)
+
+@get('/server/ticks/?')
+async def server_ticks(server, proto, match, headers, stream_id):
+    await proto.send_headers(stream_id, (
+        (':status', '200'),
+        ('content-type', 'application/json'),
+    ))
+    universe = server.universe
+    share = sorted(universe.cpu_share().items(), key=lambda item: -item[1])
+    ticks = server.metrics.to_dict()
+    ticks['scheduler'] = collections.OrderedDict([
+        # ticks where the budget ran out before every runnable ticker ran
+        ('overruns', universe.scheduler.overruns),
+        ('runnable', universe.scheduler.runnable_count),
+        ('cpu_share', [
+            ['{}:{}'.format(*owner), spent]
+            for owner, spent in share[:CPU_SHARE_TOP]
+        ]),
+    ])
+    payload = json.dumps(ticks).encode('utf-8')
+    await proto.send_data(stream_id, payload, end_stream=True)
+
+@get('/machines/([^/]*)/ipc/?')
+async def machine_ipc(server, proto, match, headers, stream_id):
+    mach = await server_verify_machine_auth(server, proto, stream_id, headers, expected_id=match.group(1))
+    if mach is None:
+        return
+
+    tracer = server.universe.tracer
+    await proto.send_headers(stream_id, (
+        (':status', '200'),
+        ('content-type', 'application/json'),
+    ))
+    payload = json.dumps({
+        'tracing': tracer is not None,
+        'slowest': tracer.slowest_targets(mach.id) if tracer is not None else [],
+    }).encode('utf-8')
+    await proto.send_data(stream_id, payload, end_stream=True)
+
+@get('/server/ipc/?')
+async def server_ipc(server, proto, match, headers, stream_id):
+    tracer = server.universe.tracer
+    if tracer is None:
+        await proto.send_headers(stream_id, (
+            (':status', '404'),
+            ('content-type', 'application/json'),
+        ))
+        await proto.send_data(stream_id, b'{"tracing": false}', end_stream=True)
+        return
+
+    # recent traces name machines and processes, so they're only for admins
+    admin = await server_verify_admin_auth(server, proto, stream_id, headers, fatal=False)
+    await proto.send_headers(stream_id, (
+        (':status', '200'),
+        ('content-type', 'application/json'),
+    ))
+    payload = json.dumps(tracer.to_dict(recent=admin)).encode('utf-8')
+    await proto.send_data(stream_id, payload, end_stream=True)
+
 class H2Server(object):
     def __init__(self, server):
         self.server = server
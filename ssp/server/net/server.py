@@ -1,19 +1,55 @@
 import asyncio
 import sys
 
+from ..metrics import TickMetrics, ThroughputReport
+
 class Server(object):
     TICK_RATE = 10
+
+    # what to do about ticks whose deadline passed while the server was busy
+    CATCH_UP_SKIP = 'skip'
+    CATCH_UP_RUN = 'run'
+    CATCH_UP_POLICIES = (CATCH_UP_SKIP, CATCH_UP_RUN)
+    MAX_CATCH_UP = 3
     
-    def __init__(self, loop, universe):
+    def __init__(self, loop, universe, tick_rate=None, catch_up=CATCH_UP_SKIP, max_catch_up=MAX_CATCH_UP, tick_executor=None, turbo=False, max_ticks=None, admin_secret=None):
+        if catch_up not in self.CATCH_UP_POLICIES:
+            raise ValueError('unknown catch up policy: {}'.format(catch_up))
+
+        if tick_rate is None:
+            tick_rate = self.TICK_RATE
+        if not tick_rate > 0:
+            raise ValueError('tick rate must be positive: {}'.format(tick_rate))
+
         self.loop = loop
-        self.tick_rate = self.TICK_RATE
+        self.tick_rate = tick_rate
         self.tick_time = 1/float(self.tick_rate)
+        self.catch_up = catch_up
+        self.max_catch_up = max_catch_up
+        # when set, universe ticks are run on this executor so the event loop
+        # can keep serving requests while emulators are running
+        self.tick_executor = tick_executor
+        # in turbo mode ticks are run back to back instead of at the tick
+        # rate, which still sets how much simulated time each tick covers
+        self.turbo = turbo
+        self.max_ticks = max_ticks
+        # signs requests to the admin endpoints, which are refused without it
+        self.admin_secret = admin_secret
+        self.report = None
+        self.next_deadline = None
+        self.metrics = TickMetrics()
         self.universe = universe
+        self.universe.tick_time = self.tick_time
         self.stopping = False
         self.finished = asyncio.Future()
 
     def start(self):
-        self.schedule_tick()
+        if self.turbo:
+            self.loop.create_task(self.run_turbo())
+            return
+
+        self.next_deadline = self.loop.time() + self.tick_time
+        self.schedule_tick(self.next_deadline)
 
     def stop(self):
         self.stopping = True
@@ -27,12 +63,108 @@ class Server(object):
         self.loop.call_at(when, self.tick)
 
     def tick(self):
-        try:
-            self.universe.tick()
-        except:
-            sys.excepthook(*sys.exc_info())
+        started = self.loop.time()
+        lateness = max(0.0, started - self.next_deadline)
+
+        # whole ticks missed since the deadline, these are either dropped or
+        # (up to a limit) run back to back
+        missed = int(lateness // self.tick_time)
+        ticks = 1
+        if missed > 0:
+            if self.catch_up == self.CATCH_UP_RUN:
+                extra = min(missed, self.max_catch_up)
+                ticks += extra
+                self.metrics.caught_up += extra
+                self.metrics.skipped += missed - extra
+                self.universe.skip_ticks(missed - extra)
+            else:
+                self.metrics.skipped += missed
+                self.universe.skip_ticks(missed)
+
+        if self.tick_executor is None:
+            for _ in range(ticks):
+                self.run_tick()
+            self.finish_tick(started, lateness, missed, ticks)
+        else:
+            self.run_tick_off_loop(started, lateness, missed, ticks, ticks)
+
+    def run_tick_off_loop(self, started, lateness, missed, ticks, remaining):
+        self.universe.start_tick()
+        future = self.loop.run_in_executor(self.tick_executor, self.universe.step)
+
+        def done(future):
+            exc = future.exception()
+            if exc is not None:
+                sys.excepthook(type(exc), exc, exc.__traceback__)
+
+            # like run_tick, a failing tick is reported and the server keeps
+            # ticking rather than stalling with nothing scheduled
+            try:
+                self.universe.finish_tick()
+            except:
+                sys.excepthook(*sys.exc_info())
+
+            if remaining > 1:
+                self.run_tick_off_loop(started, lateness, missed, ticks, remaining - 1)
+            else:
+                self.finish_tick(started, lateness, missed, ticks)
+
+        future.add_done_callback(done)
+
+    def finish_tick(self, started, lateness, missed, ticks):
+        duration = self.loop.time() - started
+        self.metrics.ticks += ticks
+        self.metrics.duration.record(duration)
+        self.metrics.lateness.record(lateness)
+        if duration > self.tick_time:
+            self.metrics.overruns += 1
+            self.metrics.overrun.record(duration - self.tick_time)
+
+        # deadlines are absolute so slow ticks don't push every later tick back
+        self.next_deadline += (missed + 1) * self.tick_time
 
         if not self.stopping:
-            self.schedule_tick()
+            self.schedule_tick(self.next_deadline)
         else:
             self.finished.set_result(None)
+
+    async def run_turbo(self):
+        started = self.loop.time()
+        instructions = self.universe.instructions
+        ticks = 0
+
+        while not self.stopping:
+            if (self.max_ticks is not None) and (ticks >= self.max_ticks):
+                break
+
+            tick_started = self.loop.time()
+            self.run_tick()
+            await self.settle_ipc()
+            self.metrics.ticks += 1
+            self.metrics.duration.record(self.loop.time() - tick_started)
+            ticks += 1
+
+        self.report = ThroughputReport(
+            ticks, self.universe.instructions - instructions,
+            self.loop.time() - started
+        )
+        self.finished.set_result(None)
+
+    async def settle_ipc(self):
+        # IPC started during a tick runs as tasks on the loop, so keep
+        # yielding to them until a pass goes by where none start or finish,
+        # that way everything they deliver is seen by the next tick
+        universe = self.universe
+        while True:
+            progress = (universe.ipc_started, universe.ipc_finished)
+            # done callbacks run one loop iteration after their task finishes
+            await asyncio.sleep(0)
+            await asyncio.sleep(0)
+            if progress == (universe.ipc_started, universe.ipc_finished):
+                break
+
+    def run_tick(self):
+        try:
+            self.universe.tick()
+        except:
+            sys.excepthook(*sys.exc_info())
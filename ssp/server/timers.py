@@ -0,0 +1,87 @@
+class Timer(object):
+    """
+    A callback scheduled on a TimerWheel, cancelling it is O(1) as cancelled
+    timers are only discarded when their slot comes up.
+    """
+
+    __slots__ = ('expires', 'callback', 'args', 'cancelled')
+
+    def __init__(self, expires, callback, args):
+        self.expires = expires
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+class TimerWheel(object):
+    """
+    Hierarchical timer wheel counting in ticks. Each level has SLOTS slots
+    covering SLOTS times the range of the level below it, timers go in the
+    lowest level their delay fits in and cascade down a level each time the
+    level below wraps, so scheduling and each tick's work are O(1) per timer.
+    """
+
+    SLOT_BITS = 8
+    SLOTS = 1 << SLOT_BITS
+    SLOT_MASK = SLOTS - 1
+    LEVELS = 4
+    MAX_DELAY = (1 << (SLOT_BITS * LEVELS)) - 1
+
+    def __init__(self):
+        self.now = 0
+        self._count = 0
+        self._levels = [
+            [[] for _ in range(self.SLOTS)]
+            for _ in range(self.LEVELS)
+        ]
+
+    def __len__(self):
+        return self._count
+
+    def schedule(self, delay, callback, *args):
+        delay = min(max(1, int(delay)), self.MAX_DELAY)
+        timer = Timer(self.now + delay, callback, args)
+        self._insert(timer)
+        self._count += 1
+        return timer
+
+    def advance(self, ticks=1):
+        for _ in range(ticks):
+            self.now += 1
+
+            # when a level wraps, the matching slot of the level above it is
+            # redistributed, starting from the highest level that wrapped
+            wrapped = 0
+            while (wrapped + 1 < self.LEVELS) and \
+                    (self.now & ((1 << (self.SLOT_BITS * (wrapped + 1))) - 1)) == 0:
+                wrapped += 1
+            for level in range(wrapped, 0, -1):
+                self._cascade(level)
+
+            slot = self.now & self.SLOT_MASK
+            expired = self._levels[0][slot]
+            self._levels[0][slot] = []
+            for timer in expired:
+                self._count -= 1
+                if not timer.cancelled:
+                    timer.callback(*timer.args)
+
+    def _cascade(self, level):
+        slot = (self.now >> (self.SLOT_BITS * level)) & self.SLOT_MASK
+        timers = self._levels[level][slot]
+        self._levels[level][slot] = []
+        for timer in timers:
+            if timer.cancelled:
+                self._count -= 1
+            else:
+                self._insert(timer)
+
+    def _insert(self, timer):
+        delay = timer.expires - self.now
+        level = 0
+        while (level + 1 < self.LEVELS) and (delay >> (self.SLOT_BITS * (level + 1))):
+            level += 1
+        slot = (timer.expires >> (self.SLOT_BITS * level)) & self.SLOT_MASK
+        self._levels[level][slot].append(timer)
@@ -0,0 +1,56 @@
+import string
+
+class Address(object):
+    """
+    A parsed IPC target: "<machine>:<receiver>" for a receiver on another
+    machine, or just "<receiver>", where a receiver is a pid or a service
+    name. Addresses are interned by target string, so parsing a target that
+    has been seen before is a single dict lookup.
+    """
+
+    __slots__ = ('target', 'machine', 'receiver', 'pid')
+
+    # the intern table is emptied when it gets this big, as programs can
+    # build as many distinct targets as they like
+    MAX_INTERNED = 4096
+
+    _interned = {}
+
+    def __init__(self, target):
+        self.target = target
+
+        idx = target.find(':')
+        if idx < 0:
+            self.machine = None
+            self.receiver = target
+        else:
+            self.machine = target[:idx]
+            self.receiver = target[idx+1:]
+
+        self.pid = None
+        if (len(self.receiver) > 0) and (self.receiver.strip(string.digits) == ''):
+            self.pid = int(self.receiver)
+
+    @property
+    def is_remote(self):
+        return self.machine is not None
+
+    @classmethod
+    def parse(cls, target):
+        """
+        Returns the interned address for target, or None if target isn't a
+        string and so can't be an address.
+        """
+        if not isinstance(target, str):
+            return None
+
+        addr = cls._interned.get(target)
+        if addr is None:
+            if len(cls._interned) >= cls.MAX_INTERNED:
+                cls._interned.clear()
+            addr = cls(target)
+            cls._interned[target] = addr
+        return addr
+
+    def __repr__(self):
+        return 'Address({})'.format(repr(self.target))
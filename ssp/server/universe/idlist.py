@@ -1,4 +1,6 @@
-import random
+import collections
+import functools
+import os
 import string
 
 def integer_id_generator(next_id=0):
@@ -6,14 +8,50 @@ def integer_id_generator(next_id=0):
         yield next_id
         next_id += 1
 
-def generate_random_id(length=20, charset=string.ascii_uppercase + string.digits, rand = random.SystemRandom()):
-    return ''.join(rand.choice(charset) for _ in range(length))
-
-def random_string_id_generator(length=20, charset=string.ascii_uppercase + string.digits, rand = random.SystemRandom()):
+def random_chars(count, charset=string.ascii_uppercase + string.digits):
+    """
+    Picks count characters from charset using as few os.urandom reads as
+    possible. Bytes that would bias the modulo are rejected, so charset must
+    have at most 256 characters, each of which must fit in a byte.
+    """
+    table, rejected = _char_table(charset)
+    chunks = []
+    have = 0
+    while have < count:
+        needed = count - have
+        # read a little extra to make up for rejected bytes
+        raw = os.urandom(needed + needed // 4 + 8)
+        chunk = raw.translate(table, rejected)[:needed]
+        chunks.append(chunk)
+        have += len(chunk)
+    return b''.join(chunks).decode('latin-1')
+
+@functools.lru_cache(maxsize=16)
+def _char_table(charset):
+    limit = 256 - (256 % len(charset))
+    table = bytes(ord(charset[byte % len(charset)]) for byte in range(256))
+    return table, bytes(range(limit, 256))
+
+def generate_random_id(length=20, charset=string.ascii_uppercase + string.digits):
+    return random_chars(length, charset)
+
+def random_string_id_generator(length=20, charset=string.ascii_uppercase + string.digits, batch=256):
     while True:
-        yield generate_random_id(length, charset, rand)
+        chars = random_chars(length * batch, charset)
+        for start in range(0, len(chars), length):
+            yield chars[start:start+length]
 
 class IdList(object):
+    """
+    Maps generated ids to values. With a free list, removed ids are recycled
+    (which requires integer ids) and tagged with a generation count in their
+    high bits, so an id kept after it was removed never matches the value
+    that reuses its slot and can be recognised with is_stale.
+    """
+
+    GENERATION_SHIFT = 20
+    SLOT_MASK = (1 << GENERATION_SHIFT) - 1
+
     def __init__(self, id_generator=None, use_free_list=False):
         if id_generator is None:
             id_generator = integer_id_generator()
@@ -22,7 +60,8 @@ class IdList(object):
         self.id_generator = id_generator
             
         self._use_free_list = use_free_list
-        self._free_list = []
+        self._free_list = collections.deque()
+        self._generations = {}
 
     def __getitem__(self, index):
         return self.dict[index]
@@ -36,14 +75,20 @@ class IdList(object):
     def __contains__(self, index):
         return index in self.dict
 
+    def __len__(self):
+        return len(self.dict)
+
     def generate_id(self):
         id = None
         
         if self._use_free_list and len(self._free_list) > 0:
-            id = self._free_list.pop(0)
+            slot = self._free_list.popleft()
+            id = (self._generations[slot] << self.GENERATION_SHIFT) | slot
         else:
             while (id is None) or (id in self.dict):
                 id = next(self.id_generator)
+            if self._use_free_list and id > self.SLOT_MASK:
+                raise Exception('id list out of slots')
 
         return id
 
@@ -61,7 +106,32 @@ class IdList(object):
     def remove(self, id):
         del self.dict[id]
         if self._use_free_list:
-            self._free_list.append(id)
+            slot = id & self.SLOT_MASK
+            self._generations[slot] = (id >> self.GENERATION_SHIFT) + 1
+            self._free_list.append(slot)
+
+    def is_stale(self, id):
+        if (not self._use_free_list) or (not isinstance(id, int)) or (id < 0):
+            return False
+        slot = id & self.SLOT_MASK
+        return self._generations.get(slot, 0) != (id >> self.GENERATION_SHIFT)
+
+    def get_allocator_state(self):
+        """
+        The free list and slot generations, which have to be saved along with
+        the values for ids to stay unique (and stale ids stale) once restored.
+        """
+        return [list(self._free_list), sorted(self._generations.items())]
+
+    def set_allocator_state(self, state):
+        free_list, generations = state
+        self._free_list = collections.deque(free_list)
+        self._generations = dict((slot, generation) for slot, generation in generations)
+
+        # new slots are handed out after every slot that has been used
+        slots = set(self._generations.keys())
+        slots.update(id & self.SLOT_MASK for id in self.dict.keys())
+        self.id_generator = integer_id_generator(max(slots) + 1 if slots else 0)
 
     def keys(self):
         return self.dict.keys()
@@ -1,53 +1,88 @@
+import functools
 import logging
-import string
+import threading
 import weakref
 from pyee import EventEmitter
 
+import ssp.logging
 from . import process, idlist, machine_services
+from .address import Address
 
 
-def maybe_remote_address(addr):
-    if not isinstance(addr, str):
-        return None
-    
-    idx = addr.find(':')
-    if idx < 0:
-        return None
-
-    return (addr[:idx], addr[idx+1:])
+# factories for recreating saved processes, by Process.KIND
+PROCESS_KINDS = dict(machine_services.FACTORIES)
+PROCESS_KINDS[process.EmuProcess.KIND] = process.EmuProcess
+PROCESS_KINDS[machine_services.InterfaceService.KIND] = machine_services.InterfaceService
 
 class Machine(object):
-    def __init__(self, universe, id):
+    # the route cache is emptied when it gets this big
+    MAX_ROUTES = 1024
+
+    # most interface endpoints kept for serving interface requests
+    INTERFACE_POOL_SIZE = 4
+
+    def __init__(self, universe, id, secret=None):
         self.logger = universe.logger.getChild('machines.{}'.format(id))
         
         self.universe = universe
         self.id = id
-        self.secret = idlist.generate_random_id(length=40)
+        if secret is None:
+            secret = idlist.generate_random_id(length=40)
+        self.secret = secret
         
         self.processes = idlist.IdList(idlist.integer_id_generator(1000))
         self.services = weakref.WeakValueDictionary()
+        # built-in services that are started by the first message sent to them
+        self.lazy_services = set()
+        self.interfaces = []
+        # lazy services can be started by a tick running off the loop's thread
+        # while the loop is creating processes too
+        self._process_lock = threading.RLock()
 
         self.register_tick = universe.register_tick
         self.unregister_tick = universe.unregister_tick
+        self.wake = universe.wake
+        self.sleep = universe.sleep
 
         self.events = EventEmitter()
 
+        # receivers by target, replaced whenever the processes or services
+        # they could resolve to change
+        self.routes = {}
+        self.events.on('process_created', self._invalidate_routes)
+        self.events.on('process_killed', self._invalidate_routes)
+
     def create_process(self, ppid=None, factory=process.EmuProcess):
-        pid = self.processes.add_fn(lambda id: factory(self, id, ppid))
-        proc = self.processes[pid]
+        with self._process_lock:
+            pid = self.processes.add_fn(lambda id: factory(self, id, ppid))
+            proc = self.processes[pid]
 
         self.events.emit('process_created', proc)
+        self.mark_dirty()
         return proc
 
+    def interface_endpoint(self):
+        """
+        Picks the least busy pooled interface endpoint, starting another if
+        they're all busy and the pool isn't full.
+        """
+        endpoint = None
+        if len(self.interfaces) > 0:
+            endpoint = min(self.interfaces, key=lambda e: len(e.pending))
+
+        if ((endpoint is None) or (len(endpoint.pending) > 0)) and \
+                (len(self.interfaces) < self.INTERFACE_POOL_SIZE):
+            endpoint = self.create_process(factory=machine_services.InterfaceService)
+            self.interfaces.append(endpoint)
+
+        return endpoint
+
     def start_process(self, program):
-        parent = self.create_process(factory=machine_services.InterfaceService)
-        try:
-            proc = self.create_process(ppid=parent.pid)
-            proc.run_program(program)
+        parent = self.interface_endpoint()
+        proc = self.create_process(ppid=parent.pid, factory=self.universe.process_pool.acquire)
+        proc.run_program(program)
 
-            return (proc, parent)
-        finally:
-            self.kill_process(parent.pid)
+        return (proc, parent)
 
     def kill_process(self, pid):
         proc = self.processes.get(pid)
@@ -57,16 +92,92 @@ class Machine(object):
         del self.processes[pid]
         self.events.emit('process_killed', proc)
         proc.kill()
+        self.mark_dirty()
 
     async def interface_send(self, target, values):
-        parent = self.create_process(factory=machine_services.InterfaceService)
-        try:
-            return await self.send_ipc(str(parent.pid), target, values)
-        finally:
-            self.kill_process(parent.pid)
+        return await self.interface_endpoint().request(target, values)
+
+    def mark_dirty(self, proc=None):
+        """
+        Marks the machine to be saved, or only proc if that's all that changed.
+        """
+        self.universe.mark_dirty(self.id, None if proc is None else proc.pid)
+
+    def is_idle(self):
+        return all(proc.is_idle() for proc in self.processes.values())
+
+    def get_state(self):
+        return {
+            'id': self.id,
+            'secret': self.secret,
+            'processes': [
+                [proc.KIND, proc.pid, proc.ppid, proc.get_state()]
+                for proc in self.processes.values()
+                if proc.KIND is not None
+            ],
+            'services': [
+                [service, proc.pid]
+                for service, proc in self.services.items()
+            ],
+            'lazy_services': sorted(self.lazy_services),
+        }
+
+    @classmethod
+    def from_state(cls, universe, state):
+        machine = cls(universe, state['id'], state['secret'])
+
+        next_pid = 1000
+        for kind, pid, ppid, proc_state in state['processes']:
+            proc = PROCESS_KINDS[kind](machine, pid, ppid)
+            machine.processes[pid] = proc
+            proc.set_state(proc_state)
+            next_pid = max(next_pid, pid + 1)
+            if kind == machine_services.InterfaceService.KIND:
+                machine.interfaces.append(proc)
+        machine.processes.id_generator = idlist.integer_id_generator(next_pid)
+
+        for service, pid in state['services']:
+            machine.services[service] = machine.processes[pid]
+        machine.lazy_services.update(state.get('lazy_services', []))
+
+        return machine
+
+    def unload(self):
+        for proc in self.processes.values():
+            proc.release()
+            self.universe.scheduler.forget((self.id, proc.pid))
+            if proc.pool is not None:
+                proc.pool.recycle(proc)
+        ssp.logging.forget_loggers(self.logger)
+        if self.universe.tracer is not None:
+            self.universe.tracer.forget_machine(self.id)
 
     def register_service(self, proc, service):
         self.services[service] = proc
+        self._invalidate_routes()
+        self.mark_dirty()
+
+    def add_lazy_service(self, svc):
+        """
+        Makes a built-in service available without starting it, it's started
+        when something first sends to it (within the sender's tick) and then
+        kept until the machine goes.
+        """
+        if svc not in machine_services.FACTORIES:
+            self.logger.error('tried to add non-existant service: {}'.format(svc))
+            return
+        if svc not in self.services:
+            self.lazy_services.add(svc)
+            self._invalidate_routes()
+            self.mark_dirty()
+
+    def _start_lazy_service(self, svc):
+        with self._process_lock:
+            proc = self.services.get(svc)
+            if (proc is None) and (svc in self.lazy_services):
+                self.lazy_services.discard(svc)
+                proc = self.start_builtin_service(svc)
+            return proc
 
     def start_builtin_service(self, svc):
         factory = machine_services.FACTORIES.get(svc)
@@ -79,22 +190,125 @@ class Machine(object):
         return proc
 
     async def send_ipc(self, sender, target, values):
-        addr = maybe_remote_address(target)
-        if addr is not None:
-            dest = self.universe.machines.get(addr[0])
+        addr = Address.parse(target)
+        if (addr is not None) and addr.is_remote:
+            dest = self.universe.get_machine(addr.machine)
             if dest is None:
-                raise Exception('destination machine {} not found'.format(addr[0]))
-            return await dest.send_ipc('{}:{}'.format(self.id, sender), addr[1], values)
+                raise Exception('destination machine {} not found'.format(addr.machine))
+            return await dest.send_ipc('{}:{}'.format(self.id, sender), addr.receiver, values)
 
-        if (len(target) > 0) and (target[0] in string.digits):
-            target = int(target)
-        
-        if target in self.processes:
-            return await self.processes[target].send_ipc(sender, values)
+        proc = self.local_process(target)
+        if proc is None:
+            raise Exception('no receiver {}'.format(target))
+        return await proc.send_ipc(sender, values)
+
+    def send_remote(self, sender_pid, sender_generation, target, values, wants_response):
+        """
+        Queues a message from a local process for a process on another
+        machine, returning False if target isn't a remote address. Messages
+        are delivered in batches at the end of the tick, in the order they
+        were sent, and so are the replies.
+        """
+        addr = Address.parse(target)
+        if (addr is None) or not addr.is_remote:
+            return False
+
+        trace = None
+        tracer = self.universe.tracer
+        if tracer is not None:
+            trace = tracer.start(self.id, target, tracer.KIND_REMOTE, wants_response)
+
+        self.universe.post(addr.machine, _deliver_remote,
+            self.id, sender_pid, sender_generation, addr.receiver, values, wants_response, trace)
+        return True
+
+    def local_process(self, target):
+        """
+        The process or service on this machine that target refers to, or None
+        if it's remote or there's no such receiver. Resolutions are cached, so
+        this is usually a single dict lookup.
+        """
+        routes = self.routes
+        try:
+            return routes[target]
+        except KeyError:
+            pass
+        except TypeError:
+            # unhashable values (lists, dicts) can't be addresses
+            return None
+
+        proc = None
+        addr = Address.parse(target)
+        if (addr is not None) and not addr.is_remote:
+            if addr.pid is not None:
+                proc = self.processes.get(addr.pid)
+            if proc is None:
+                proc = self.services.get(addr.receiver)
+            if (proc is None) and (addr.receiver in self.lazy_services):
+                proc = self._start_lazy_service(addr.receiver)
+
+        # if the routes were invalidated meanwhile this goes into the old
+        # cache, which is no longer used
+        if len(routes) >= self.MAX_ROUTES:
+            routes.clear()
+        routes[target] = proc
+        return proc
+
+    def _invalidate_routes(self, proc=None):
+        self.routes = {}
+
+def _deliver_remote(universe, dest_id, dest, sender_machine, sender_pid, sender_generation,
+        target, values, wants_response, trace):
+    sender = (sender_machine, sender_pid, sender_generation)
+    if dest is None:
+        _send_failed(universe, sender,
+            Exception('destination machine {} not found'.format(dest_id)), trace)
+        return
+
+    proc = dest.local_process(target)
+    if proc is None:
+        _send_failed(universe, sender, Exception('no receiver {}'.format(target)), trace)
+        return
+
+    reply = None
+    if wants_response:
+        # the reply may come during any later tick, so it's batched back from
+        # the receiving machine
+        def reply(response):
+            universe.post(sender_machine, _deliver_response,
+                sender_pid, sender_generation, response, trace)
+
+    # a message that doesn't fit in the receiver's mailbox waits for room,
+    # and the sender is held back until it's been accepted
+    accepted = functools.partial(universe.post, sender_machine, _send_accepted,
+        sender_pid, sender_generation)
+    if not proc.deliver('{}:{}'.format(sender_machine, sender_pid), values, reply, accepted):
+        universe.post(sender_machine, _send_held, sender_pid, sender_generation)
+    if trace is not None:
+        universe.tracer.delivered(trace)
+
+def _deliver_response(universe, dest_id, dest, pid, generation, values, trace):
+    proc = dest.processes.get(pid) if dest is not None else None
+    if proc is not None:
+        proc.receive_response(values, generation)
+    if trace is not None:
+        universe.tracer.responded(trace)
+
+def _send_held(universe, dest_id, dest, pid, generation):
+    proc = dest.processes.get(pid) if dest is not None else None
+    if proc is not None:
+        proc.send_held(generation)
 
-        if target in self.services:
-            svc = self.services[target]
-            if svc is not None:
-                return await svc.send_ipc(sender, values)
+def _send_accepted(universe, dest_id, dest, pid, generation):
+    proc = dest.processes.get(pid) if dest is not None else None
+    if proc is not None:
+        proc.send_accepted(generation)
 
-        raise Exception('no receiver {}'.format(target))
+def _send_failed(universe, sender, exc, trace=None):
+    if trace is not None:
+        universe.tracer.failed(trace)
+    machine_id, pid, generation = sender
+    mach = universe.machines.get(machine_id)
+    proc = mach.processes.get(pid) if mach is not None else None
+    if proc is not None:
+        proc.send_failed(exc, generation)
@@ -4,6 +4,7 @@ from .interface import InterfaceService
 BUILTIN_SERVICES = [
     'fs',
     'sys',
+    'chan',
 ]
 
 FACTORIES = {}
@@ -0,0 +1,175 @@
+from collections import OrderedDict
+from .. import process
+from ..address import Address
+
+
+class ChanService(process.Process):
+    """
+    Publish/subscribe channels. Processes (on this machine or others)
+    subscribe to named topics, and a single publish hands the message to
+    every subscriber: straight into the mailboxes of local ones, and in one
+    batch per machine for remote ones. Subscribers receive [topic, message]
+    from the channel service.
+
+    Local subscribers are unsubscribed when their process halts or is
+    killed, remote ones when a publish finds they've gone.
+    """
+
+    RET_OKAY = 0
+    RET_BAD_CMD = 1
+    RET_BAD_PARAMS = 2
+
+    KIND = 'chan'
+
+    def __init__(self, machine, pid, ppid):
+        super().__init__(machine, pid, ppid)
+
+        # topic -> subscriber addresses, in the order they subscribed
+        self._topics = {}
+        machine.events.on('process_killed', self._on_process_killed)
+        machine.events.on('process_halted', self._on_process_exited)
+
+    def handle_ipc(self, sender, values):
+        handlers = {
+            # subscribe topic -> retcode
+            'subscribe': self._subscribe,
+            # unsubscribe topic -> retcode
+            'unsubscribe': self._unsubscribe,
+            # publish topic message -> subscriber count, retcode
+            'publish': self._publish,
+        }
+
+        if len(values) > 0 and isinstance(values[0], str):
+            cmd = values[0].lower()
+        else:
+            cmd = None
+        args = values[1:]
+
+        handler = handlers.get(cmd, None)
+        if handler is None:
+            return [ChanService.RET_BAD_CMD]
+        return handler(sender, args)
+
+    def _subscribe(self, sender, args):
+        if len(args) != 1 or not isinstance(args[0], str):
+            return ChanService.RET_BAD_PARAMS
+
+        subscribers = self._topics.get(args[0])
+        if subscribers is None:
+            subscribers = self._topics[args[0]] = OrderedDict()
+        subscribers[sender] = True
+        return ChanService.RET_OKAY
+
+    def _unsubscribe(self, sender, args):
+        if len(args) != 1 or not isinstance(args[0], str):
+            return ChanService.RET_BAD_PARAMS
+
+        self._remove(args[0], sender)
+        return ChanService.RET_OKAY
+
+    def _publish(self, sender, args):
+        if len(args) != 2 or not isinstance(args[0], str):
+            return [-1, ChanService.RET_BAD_PARAMS]
+
+        topic = args[0]
+        subscribers = self._topics.get(topic)
+        if not subscribers:
+            return [0, ChanService.RET_OKAY]
+
+        message = [topic, args[1]]
+        remote = OrderedDict()
+        gone = []
+
+        for subscriber in subscribers:
+            addr = Address.parse(subscriber)
+            if addr.is_remote:
+                remote.setdefault(addr.machine, []).append(addr.receiver)
+                continue
+
+            proc = self.machine.local_process(subscriber)
+            if proc is None:
+                gone.append(subscriber)
+                continue
+            try:
+                proc.deliver('chan', message)
+            except process.MailboxFull:
+                # counted by the subscriber's mailbox
+                pass
+
+        for subscriber in gone:
+            self._remove(topic, subscriber)
+
+        sender = '{}:chan'.format(self.machine.id)
+        for machine_id, receivers in remote.items():
+            self.machine.universe.post(machine_id, _deliver_published,
+                self.machine.id, receivers, sender, message)
+
+        return [len(subscribers), ChanService.RET_OKAY]
+
+    def _remove(self, topic, subscriber):
+        subscribers = self._topics.get(topic)
+        if subscribers is None:
+            return
+        subscribers.pop(subscriber, None)
+        if len(subscribers) == 0:
+            del self._topics[topic]
+
+    def remove_subscriber(self, subscriber):
+        """
+        Unsubscribes subscriber from every topic, returning whether it was
+        subscribed to any.
+        """
+        topics = [topic for topic, subscribers in self._topics.items() if subscriber in subscribers]
+        for topic in topics:
+            self._remove(topic, subscriber)
+        return len(topics) > 0
+
+    def _on_process_exited(self, proc):
+        if self.remove_subscriber(str(proc.pid)):
+            self.machine.mark_dirty(self)
+
+    def _on_process_killed(self, proc):
+        if proc is self:
+            self.machine.events.remove_listener('process_killed', self._on_process_killed)
+            self.machine.events.remove_listener('process_halted', self._on_process_exited)
+            return
+        self._on_process_exited(proc)
+
+    def get_state(self):
+        return {
+            'topics': [
+                [topic, list(subscribers.keys())]
+                for topic, subscribers in self._topics.items()
+            ],
+        }
+
+    def set_state(self, state):
+        for topic, subscribers in state['topics']:
+            self._topics[topic] = OrderedDict((subscriber, True) for subscriber in subscribers)
+
+
+def _deliver_published(universe, dest_id, dest, chan_machine, receivers, sender, message):
+    gone = []
+    for receiver in receivers:
+        proc = dest.local_process(receiver) if dest is not None else None
+        if (proc is None) or proc.halted:
+            gone.append('{}:{}'.format(dest_id, receiver))
+            continue
+        try:
+            proc.deliver(sender, message)
+        except process.MailboxFull:
+            pass
+
+    if len(gone) > 0:
+        universe.post(chan_machine, _remove_subscribers, gone)
+
+def _remove_subscribers(universe, dest_id, dest, subscribers):
+    chan = dest.services.get('chan') if dest is not None else None
+    if not isinstance(chan, ChanService):
+        return
+    removed = [chan.remove_subscriber(subscriber) for subscriber in subscribers]
+    if any(removed):
+        dest.mark_dirty(chan)
+
+
+factory = ChanService
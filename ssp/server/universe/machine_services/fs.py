@@ -11,13 +11,23 @@ class FsService(process.Process):
     RET_ALREADY_OPEN = 4
     RET_BAD_HANDLE = 5
 
+    KIND = 'fs'
+
     def __init__(self, machine, pid, ppid):
         super().__init__(machine, pid, ppid)
 
-        self._filesys = FileSystem()
+        # built on the first command, as the service is started inside the
+        # tick of whatever first sends to it
+        self._fs = None
         self._handles = defaultdict(ProcessHandles)
 
-    async def send_ipc(self, sender, values):
+    @property
+    def _filesys(self):
+        if self._fs is None:
+            self._fs = FileSystem()
+        return self._fs
+
+    def handle_ipc(self, sender, values):
         response = None
 
         handlers = {
@@ -58,7 +68,7 @@ class FsService(process.Process):
         
         try:
             fs_obj = self._filesys.open(filepath, mode)
-            return [proc_handles.new_handle_for(fs_obj), FsService.RET_OKAY]
+            return [proc_handles.new_handle_for(fs_obj, filepath), FsService.RET_OKAY]
         except FsBadPath as ex:
             self.logger.debug('fs bad path: {}'.format(ex))
             return [-1, FsService.RET_BAD_PATH]
@@ -90,23 +100,78 @@ class FsService(process.Process):
 
         return FsService.RET_OKAY
 
+    def get_state(self):
+        return {
+            'filesystem': self._filesys.get_state(),
+            'handles': [
+                [sender, handles.get_state()]
+                for sender, handles in self._handles.items()
+            ],
+        }
+
+    def set_state(self, state):
+        self._filesys.set_state(state['filesystem'])
+        for sender, handles in state['handles']:
+            self._handles[sender].set_state(handles, self._filesys)
+
     def _read(self, sender, args):
         pass
 
     def _close(self, sender, args):
-        pass
+        if len(args) != 1:
+            return FsService.RET_BAD_PARAMS
+
+        proc_handles = self._handles[sender]
+
+        if not proc_handles.is_valid_handle(args[0]):
+            return FsService.RET_BAD_HANDLE
+
+        self._filesys.close(proc_handles.close(args[0]))
+        return FsService.RET_OKAY
 
 
 class ProcessHandles(object):
+    """
+    A process's open handles. Closed handles are reused, tagged with a new
+    generation each time, so a handle kept after it was closed is rejected
+    rather than referring to whatever reused its slot.
+    """
 
     def __init__(self):
         self._handles = idlist.IdList(use_free_list=True)
+        self._paths = {}
 
     def is_valid_handle(self, handle):
+        if not isinstance(handle, int) or self._handles.is_stale(handle):
+            return False
         return handle in self._handles
 
-    def new_handle_for(self, file_obj):
-        return self._handles.add(file_obj)
+    def new_handle_for(self, file_obj, path):
+        handle = self._handles.add(file_obj)
+        self._paths[handle] = path
+        return handle
+
+    def close(self, handle):
+        self._handles.remove(handle)
+        return self._paths.pop(handle)
+
+    def get_state(self):
+        return {
+            'handles': [[handle, path] for handle, path in self._paths.items()],
+            'allocator': self._handles.get_allocator_state(),
+        }
+
+    def set_state(self, state, filesys):
+        if isinstance(state, list):
+            # saved before handles could be closed
+            state = {'handles': state, 'allocator': None}
+        for handle, path in state['handles']:
+            self._handles[handle] = filesys.reopen(path)
+            self._paths[handle] = path
+        if state['allocator'] is not None:
+            self._handles.set_allocator_state(state['allocator'])
+        else:
+            self._handles.set_allocator_state([[], []])
 
     def lookup(self, handle):
         return self._handles.get(handle)
@@ -117,31 +182,114 @@ class FsBadParam(Exception): pass
 class FsAlreadyOpen(Exception): pass
 
 
+def normalise_path(filepath):
+    """
+    Drops empty and '.' parts of a path and applies '..' parts, so each
+    entity has one spelling. Paths are relative to the root either way.
+    """
+    parts = []
+    for part in filepath.split('/'):
+        if part in ('', '.'):
+            continue
+        if part == '..':
+            if parts:
+                parts.pop()
+            continue
+        parts.append(part)
+    return '/'.join(parts)
+
+
 class FileSystem(object):
+    """
+    Resolved paths (and paths that don't resolve) are cached by their
+    normalised form, so opening paths under the same deep folders doesn't
+    walk the tree each time. The cache is emptied whenever a folder is
+    created, as that can change what any path resolves to.
+    """
+
+    # most paths cached, the caches are emptied when they fill up
+    MAX_PATHS = 1024
 
     def __init__(self):
-        self._root = Folder('/')
+        self._root = Folder('/', self._tree_changed)
         self._open = set()
+        # normalised path -> entity, or None if there's nothing there
+        self._paths = {}
+        # path as given -> normalised path
+        self._keys = {}
 
     def open(self, filepath, mode):
-        if filepath in self._open:
+        key = self._key(filepath)
+        if key in self._open:
             raise FsAlreadyOpen("{} already open".format(filepath))
         create_file = 'w' == mode
-        found = self._lookup(filepath, create_file=create_file)
+        found = self._lookup(key, create_file=create_file)
         if found:
-            self._open.add(filepath)
+            self._open.add(key)
         else:
             raise FsBadPath("{} not a valid path".format(filepath))
         return found
 
-    def _lookup(self, filepath, create_file=False):
+    def close(self, filepath):
+        self._open.discard(self._key(filepath))
+
+    def reopen(self, filepath):
+        # for restoring handles that were open when the filesystem was saved
+        key = self._key(filepath)
+        self._open.add(key)
+        return self._lookup(key, create_file=True)
+
+    def get_state(self):
+        return {
+            'root': self._root.get_state(),
+            'open': list(self._open),
+        }
+
+    def set_state(self, state):
+        self._root = Folder.from_state('/', state['root'], self._tree_changed)
+        self._paths = {}
+        # saved paths may predate normalisation
+        self._open = set(self._key(path) for path in state['open'])
+
+    def _key(self, filepath):
+        try:
+            key = self._keys.get(filepath)
+        except TypeError:
+            key = None
+        if key is None:
+            if not isinstance(filepath, str):
+                raise FsBadPath("{} not a valid path".format(filepath))
+            key = normalise_path(filepath)
+            if len(self._keys) >= self.MAX_PATHS:
+                self._keys.clear()
+            self._keys[filepath] = key
+        return key
+
+    def _lookup(self, key, create_file=False):
+        paths = self._paths
+        found = paths.get(key)
+        if (found is not None) or ((key in paths) and not create_file):
+            return found
+
+        found = self._resolve(key, create_file)
+        if len(paths) >= self.MAX_PATHS:
+            paths.clear()
+        paths[key] = found
+        return found
+
+    def _resolve(self, key, create_file):
+        if key == '':
+            return self._root
         folder = self._root
-        parts = filepath.split("/")
+        parts = key.split("/")
         for folder_name in parts[:-1]:
             folder = folder.lookup_folder(folder_name)
             if not folder: return None
         return folder.lookup(parts[-1], create_file=create_file)
 
+    def _tree_changed(self):
+        self._paths = {}
+
 
 class FsEntity(object):
 
@@ -159,11 +307,13 @@ class FsEntity(object):
 
 class Folder(FsEntity):
     
-    def __init__(self, name):
+    def __init__(self, name, on_change=None):
         super().__init__(name)
 
         self._subdirs = {}
         self._files = {}
+        # called when a folder is created in this one, shared by the tree
+        self._on_change = on_change
 
     @property
     def name(self): return self._name
@@ -178,18 +328,48 @@ class Folder(FsEntity):
         if data not in self._subdirs:
             if not isinstance(data, str):
                 raise FsBadParam("folder name must be string, got: '{}'".format(data))
-            self._subdirs[data] = Folder(data)
+            self._subdirs[data] = Folder(data, self._on_change)
+            if self._on_change is not None:
+                self._on_change()
 
     def is_file(self): return False
     def is_dir(self): return True
 
+    def get_state(self):
+        # folders are walked with an explicit stack so deep trees are fine
+        state = {'dirs': {}, 'files': {}}
+        stack = [(self, state)]
+        while stack:
+            folder, folder_state = stack.pop()
+            for name, f in folder._files.items():
+                folder_state['files'][name] = f.read()
+            for name, subdir in folder._subdirs.items():
+                subdir_state = {'dirs': {}, 'files': {}}
+                folder_state['dirs'][name] = subdir_state
+                stack.append((subdir, subdir_state))
+        return state
+
+    @staticmethod
+    def from_state(name, state, on_change=None):
+        root = Folder(name, on_change)
+        stack = [(root, state)]
+        while stack:
+            folder, folder_state = stack.pop()
+            for file_name, content in folder_state['files'].items():
+                folder._files[file_name] = File(file_name, content)
+            for dir_name, subdir_state in folder_state['dirs'].items():
+                subdir = Folder(dir_name, on_change)
+                folder._subdirs[dir_name] = subdir
+                stack.append((subdir, subdir_state))
+        return root
+
     def lookup_folder(self, name):
         return self._subdirs.get(name, None)
 
     def lookup_file(self, name, create_file=False):
         result = self._files.get(name, None)
-        if result is None:
-            result = File(name)
+        if (result is None) and create_file:
+            result = self._files[name] = File(name)
         return result
 
     def lookup(self, name, create_file=False):
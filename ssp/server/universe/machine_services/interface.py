@@ -1,4 +1,60 @@
-from .. import process
+import asyncio
+import functools
+
+from .. import process, idlist
 
 class InterfaceService(process.Process):
-    pass
+    """
+    Endpoint that interface (HTTP) requests are sent from. Endpoints are
+    pooled per machine and shared by concurrent requests, each of which is
+    tracked by a correlation id until its reply comes back.
+    """
+
+    KIND = 'interface'
+
+    def __init__(self, machine, pid, ppid):
+        super().__init__(machine, pid, ppid)
+
+        self._correlation_ids = idlist.integer_id_generator()
+        self.pending = {}
+
+    def is_idle(self):
+        return len(self.pending) == 0
+
+    async def request(self, target, values):
+        correlation_id = next(self._correlation_ids)
+        proc = self.machine.local_process(target)
+        if proc is None:
+            # remote targets, and unknown ones which raise, are sent from the
+            # loop but are still pending so the machine isn't hibernated
+            # until they're answered
+            future = asyncio.ensure_future(self.machine.send_ipc(str(self.pid), target, values))
+            self.pending[correlation_id] = future
+        else:
+            future = asyncio.Future()
+            self.pending[correlation_id] = future
+            self.machine.universe.between_ticks(self._deliver, proc, correlation_id, values)
+
+        try:
+            return await future
+        finally:
+            del self.pending[correlation_id]
+
+    def _deliver(self, proc, correlation_id, values):
+        try:
+            proc.deliver(str(self.pid), values, functools.partial(self._reply, correlation_id))
+        except process.MailboxFull as ex:
+            self._complete(correlation_id, None, ex)
+
+    def _reply(self, correlation_id, values):
+        # replies can come from a tick, possibly off the loop's thread
+        self.machine.universe.on_loop(self._complete, correlation_id, values, None)
+
+    def _complete(self, correlation_id, values, exc):
+        future = self.pending.get(correlation_id)
+        if (future is None) or future.done():
+            return
+        if exc is not None:
+            future.set_exception(exc)
+        else:
+            future.set_result(values)
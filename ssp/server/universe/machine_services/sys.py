@@ -1,7 +1,60 @@
 from .. import process
+from ..address import Address
 
 class SysService(process.Process):
-    async def send_ipc(self, sender, values):
-        return None
+    RET_OKAY = 0
+    RET_BAD_CMD = 1
+    RET_BAD_PARAMS = 2
+    RET_NO_PROCESS = 3
+    RET_NOT_ALLOWED = 4
+
+    KIND = 'sys'
+
+    def handle_ipc(self, sender, values):
+        handlers = {
+            # exit -> retcode
+            'exit': self._exit,
+            # kill pid -> retcode
+            'kill': self._kill_process,
+        }
+
+        if (len(values) > 0) and isinstance(values[0], str):
+            cmd = values[0].lower()
+        else:
+            cmd = None
+        args = values[1:]
+
+        handler = handlers.get(cmd, None)
+        if handler is None:
+            return [SysService.RET_BAD_CMD]
+        return handler(sender, args)
+
+    def _exit(self, sender, args):
+        if len(args) != 0:
+            return [SysService.RET_BAD_PARAMS]
+        return self._kill_process(sender, [sender])
+
+    def _kill_process(self, sender, args):
+        if len(args) != 1:
+            return [SysService.RET_BAD_PARAMS]
+
+        # only processes on this machine can kill its processes
+        addr = Address.parse(sender)
+        if (addr is None) or addr.is_remote:
+            return [SysService.RET_NOT_ALLOWED]
+
+        pid = args[0]
+        if isinstance(pid, str):
+            pid = Address.parse(pid).pid
+        if isinstance(pid, bool) or not isinstance(pid, int):
+            return [SysService.RET_BAD_PARAMS]
+
+        # services aren't started by programs, so they can't be killed by them
+        proc = self.machine.processes.get(pid)
+        if not isinstance(proc, process.EmuProcess):
+            return [SysService.RET_NO_PROCESS]
+
+        self.machine.kill_process(pid)
+        return [SysService.RET_OKAY]
 
 factory = SysService
@@ -0,0 +1,391 @@
+import collections
+import concurrent.futures
+import logging
+import os
+import shutil
+import msgpack
+
+from . import machine
+
+class Persistence(object):
+    """
+    Saves the universe to a directory as a snapshot of every machine plus an
+    append-only write-ahead log of the changes made since the snapshot.
+
+    Machines mark themselves dirty as they change, either as a whole (when
+    processes or services come and go) or one process at a time (when a
+    process runs or is sent a message), and every log_every ticks the dirty
+    machines and processes are appended to the log. Process records leave out
+    emulator programs, which only change along with the machine. States are
+    copied on the event loop, as the emulators change their values in place,
+    and packed and written on a single writer thread, in submission order, so
+    ticks never wait on encoding or the disk.
+
+    Every log_every * snapshot_every ticks a new snapshot is started: the log
+    so far is set aside, and snapshot_batch machines are copied into the
+    snapshot each tick until they're all written, when it replaces the old
+    snapshot and the old log is removed. Log records carry the sequence
+    number of the flush that wrote them and the snapshot records the last
+    sequence number it covers, so records from before a snapshot are ignored
+    and ones made while it was being written are replayed over it. Restoring
+    reads the snapshot and replays the logs over it in order.
+    """
+
+    logger = logging.getLogger(__name__)
+
+    SNAPSHOT_FILE = 'universe.snapshot'
+    LOG_FILE = 'universe.log'
+    PREV_LOG_FILE = 'universe.log.prev'
+    VERSION = 1
+
+    RECORD_MACHINE = 0
+    RECORD_REMOVED = 1
+    RECORD_NOW = 2
+    RECORD_PROCESS = 3
+
+    # deeper states can't be packed by msgpack anyway
+    MAX_DEPTH = 512
+
+    def __init__(self, universe, path, log_every=10, snapshot_every=600,
+            snapshot_batch=500, sync=False):
+        self.universe = universe
+        self.path = path
+        self.log_every = log_every
+        self.snapshot_every = snapshot_every
+        self.snapshot_batch = snapshot_batch
+        self.sync = sync
+
+        self.sequence = 0
+        self.dirty = set()
+        # machine id -> pids of processes changed, for machines that aren't
+        # dirty as a whole
+        self.dirty_processes = {}
+        self.removed = set()
+        # store files of woken machines, deleted once their state is logged,
+        # as (id, wake generation) so a file saved by hibernating the machine
+        # again isn't deleted
+        self.released = []
+        self.woken = {}
+        self._wakes = 0
+
+        self._ticks = 0
+        self._flushes = 0
+        self._writer = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._pending = collections.deque()
+        # ids of machines still to be copied into the snapshot being written
+        self._snapshot_ids = None
+        # only touched on the writer thread
+        self._snapshot_file = None
+
+        os.makedirs(path, exist_ok=True)
+        universe.persistence = self
+
+    @property
+    def snapshot_path(self):
+        return os.path.join(self.path, self.SNAPSHOT_FILE)
+
+    @property
+    def log_path(self):
+        return os.path.join(self.path, self.LOG_FILE)
+
+    @property
+    def prev_log_path(self):
+        return os.path.join(self.path, self.PREV_LOG_FILE)
+
+    @property
+    def snapshotting(self):
+        return self._snapshot_ids is not None
+
+    def mark_dirty(self, id, pid=None):
+        self.removed.discard(id)
+        if pid is None:
+            self.dirty.add(id)
+            self.dirty_processes.pop(id, None)
+        elif id not in self.dirty:
+            pids = self.dirty_processes.get(id)
+            if pids is None:
+                pids = self.dirty_processes[id] = set()
+            pids.add(pid)
+
+    def machine_removed(self, id):
+        self.dirty.discard(id)
+        self.dirty_processes.pop(id, None)
+        self.removed.add(id)
+        self.woken.pop(id, None)
+
+    def machine_woken(self, id):
+        self.mark_dirty(id)
+        self._wakes += 1
+        self.woken[id] = self._wakes
+        self.released.append((id, self._wakes))
+
+    def on_tick(self):
+        self._poll()
+        if self.snapshotting:
+            self._capture_snapshot(self.snapshot_batch)
+
+        self._ticks += 1
+        if self._ticks % self.log_every != 0:
+            return
+
+        self._flushes += 1
+        if (self._flushes % self.snapshot_every == 0) and not self.snapshotting:
+            self.snapshot()
+        else:
+            self.flush_log()
+
+    def flush_log(self):
+        """
+        Appends the machines and processes changed since the last flush to
+        the log.
+        """
+        if not (self.dirty or self.dirty_processes or self.removed):
+            return
+
+        self.sequence += 1
+        sequence = self.sequence
+        machines = self.universe.machines
+        records = [[sequence, self.RECORD_NOW, self.universe.timers.now]]
+
+        for id in self.dirty:
+            mach = machines.get(id)
+            if mach is not None:
+                records.append([sequence, self.RECORD_MACHINE, _copy(mach.get_state())])
+        for id, pids in self.dirty_processes.items():
+            mach = machines.get(id)
+            if mach is None:
+                continue
+            for pid in pids:
+                proc = mach.processes.get(pid)
+                if (proc is not None) and (proc.KIND is not None):
+                    records.append([sequence, self.RECORD_PROCESS,
+                        [id, pid, _copy(proc.get_log_state())]])
+        for id in self.removed:
+            records.append([sequence, self.RECORD_REMOVED, id])
+
+        self.dirty = set()
+        self.dirty_processes = {}
+        self.removed = set()
+        released, self.released = self.released, []
+        self._submit(self._append_log, records, released=released)
+
+    def snapshot(self):
+        """
+        Starts writing every loaded machine to a new snapshot, which is
+        finished over the following ticks (or by finish_snapshot).
+        """
+        if self.snapshotting:
+            return
+        self.flush_log()
+
+        header = {
+            'version': self.VERSION,
+            'sequence': self.sequence,
+            'now': self.universe.timers.now,
+        }
+        self._snapshot_ids = collections.deque(self.universe.machines.keys())
+        self._submit(self._begin_snapshot, header)
+
+    def finish_snapshot(self):
+        """
+        Copies the rest of the machines into the snapshot being written, if
+        there is one.
+        """
+        if self.snapshotting:
+            self._capture_snapshot()
+
+    def wait(self):
+        """
+        Blocks until everything submitted so far has been written.
+        """
+        while self._pending:
+            future, released = self._pending.popleft()
+            future.result()
+            self._release(released)
+
+    def close(self):
+        self.finish_snapshot()
+        self.snapshot()
+        self.finish_snapshot()
+        self.wait()
+        self._writer.shutdown()
+
+    def _capture_snapshot(self, count=None):
+        ids = self._snapshot_ids
+        machines = self.universe.machines
+        states = []
+        while ids and ((count is None) or (len(states) < count)):
+            # machines removed or hibernated since are logged as such
+            mach = machines.get(ids.popleft())
+            if mach is not None:
+                states.append(_copy(mach.get_state()))
+
+        if states:
+            self._submit(self._write_snapshot, states)
+        if not ids:
+            self._snapshot_ids = None
+            self._submit(self._finish_snapshot)
+
+    def _submit(self, fn, *args, released=()):
+        self._pending.append((self._writer.submit(fn, *args), released))
+        self._poll()
+
+    def _poll(self):
+        while self._pending and self._pending[0][0].done():
+            future, released = self._pending.popleft()
+            exc = future.exception()
+            if exc is not None:
+                self.logger.error('failed to persist universe: {}'.format(repr(exc)))
+            else:
+                self._release(released)
+
+    def _release(self, released):
+        # this runs on the loop, so whether a machine has hibernated again
+        # since it was woken can't change underneath it
+        store = self.universe.store
+        for id, generation in released:
+            if (id in self.universe.hibernated) or (self.woken.get(id) != generation):
+                continue
+            del self.woken[id]
+            if store is not None:
+                store.delete(id)
+
+    def _sync(self, f):
+        f.flush()
+        if self.sync:
+            os.fsync(f.fileno())
+
+    def _append_log(self, records):
+        packer = msgpack.Packer(use_bin_type=True)
+        data = b''.join(packer.pack(record) for record in records)
+        with open(self.log_path, 'ab') as f:
+            f.write(data)
+            self._sync(f)
+
+    def _begin_snapshot(self, header):
+        # the log is set aside until the snapshot is complete, added to the
+        # one left by an unfinished snapshot if there is one
+        if os.path.exists(self.log_path):
+            if os.path.exists(self.prev_log_path):
+                with open(self.log_path, 'rb') as src, open(self.prev_log_path, 'ab') as dst:
+                    shutil.copyfileobj(src, dst)
+                    self._sync(dst)
+                os.remove(self.log_path)
+            else:
+                os.replace(self.log_path, self.prev_log_path)
+
+        self._snapshot_file = open(self.snapshot_path + '.tmp', 'wb')
+        self._snapshot_file.write(msgpack.packb(header, use_bin_type=True))
+
+    def _write_snapshot(self, states):
+        packer = msgpack.Packer(use_bin_type=True)
+        self._snapshot_file.write(b''.join(packer.pack(state) for state in states))
+
+    def _finish_snapshot(self):
+        f, self._snapshot_file = self._snapshot_file, None
+        with f:
+            self._sync(f)
+        os.replace(self.snapshot_path + '.tmp', self.snapshot_path)
+
+        # everything in the old log is covered by the snapshot now
+        if os.path.exists(self.prev_log_path):
+            os.remove(self.prev_log_path)
+
+    def read(self):
+        """
+        Reads the snapshot and logs, returning the universe's tick count and
+        the latest state of each machine by id.
+        """
+        now = 0
+        sequence = 0
+        states = collections.OrderedDict()
+
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, 'rb') as f:
+                unpacker = msgpack.Unpacker(f, encoding='utf8')
+                header = next(unpacker)
+                if header.get('version') != self.VERSION:
+                    raise Exception('unsupported snapshot version: {}'.format(header.get('version')))
+                now = header['now']
+                sequence = header['sequence']
+                for state in unpacker:
+                    states[state['id']] = state
+
+        for path in (self.prev_log_path, self.log_path):
+            if os.path.exists(path):
+                now = self._replay(path, sequence, now, states)
+
+        self.sequence = max(self.sequence, sequence)
+        return now, states
+
+    def _replay(self, path, sequence, now, states):
+        with open(path, 'rb') as f:
+            unpacker = msgpack.Unpacker(f, encoding='utf8')
+            try:
+                for record_sequence, kind, payload in unpacker:
+                    if record_sequence <= sequence:
+                        continue
+                    if kind == self.RECORD_MACHINE:
+                        states[payload['id']] = payload
+                    elif kind == self.RECORD_PROCESS:
+                        _replay_process(states, *payload)
+                    elif kind == self.RECORD_REMOVED:
+                        states.pop(payload, None)
+                    elif kind == self.RECORD_NOW:
+                        now = payload
+                    self.sequence = max(self.sequence, record_sequence)
+            except (msgpack.OutOfData, ValueError) as ex:
+                # a torn write at the end of the log, from a crash
+                self.logger.warning('ignoring truncated log: {}'.format(repr(ex)))
+        return now
+
+    def restore(self):
+        """
+        Replaces the universe's machines with the saved ones, returning how
+        many were restored.
+        """
+        universe = self.universe
+        now, states = self.read()
+        universe.timers.now = max(universe.timers.now, now)
+
+        store = universe.store
+        count = 0
+        for id, state in states.items():
+            # hibernating machines are newer on disk than in the log
+            if (store is not None) and (id in universe.hibernated):
+                continue
+
+            existing = universe.machines.get(id)
+            if existing is not None:
+                existing.unload()
+            universe.machines[id] = machine.Machine.from_state(universe, state)
+            universe.touch(id)
+            count += 1
+
+        self.logger.info('restored {} machines'.format(count))
+        return count
+
+def _replay_process(states, id, pid, log_state):
+    state = states.get(id)
+    if state is None:
+        return
+    for entry in state['processes']:
+        kind, entry_pid = entry[0], entry[1]
+        if entry_pid == pid:
+            entry[3] = machine.PROCESS_KINDS[kind].merge_log_state(entry[3], log_state)
+            return
+
+def _copy(value, depth=0):
+    """
+    Copies the lists and dicts in a state, so it can be packed on the writer
+    thread while the processes carry on changing the originals.
+    """
+    if isinstance(value, (list, tuple)):
+        if depth >= Persistence.MAX_DEPTH:
+            raise ValueError('state nested too deeply')
+        return [_copy(item, depth + 1) for item in value]
+    if isinstance(value, dict):
+        if depth >= Persistence.MAX_DEPTH:
+            raise ValueError('state nested too deeply')
+        return dict((key, _copy(item, depth + 1)) for key, item in value.items())
+    return value
@@ -1,98 +1,637 @@
 import asyncio
+import collections
+import functools
+import itertools
+import ssp.logging
 import ssp.scripting.emulator
 emu = ssp.scripting.emulator
+from .tracing import IpcTracer
+
+# tells each time a process is attached to a machine apart from the others
+_generations = itertools.count(1)
+
+class MailboxFull(Exception): pass
+
+class Mailbox(object):
+    """
+    Bounded FIFO of messages waiting for a process to receive them. Messages
+    that don't fit either wait for room, if their sender is held back until
+    they're accepted, or are refused and counted as dropped.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.dropped = 0
+        self.waited = 0
+        self.delivered = 0
+        self.high_water = 0
+        self._queue = collections.deque()
+        # (message, accepted) for messages that didn't fit, accepted is
+        # called once the message is moved into the queue
+        self._waiting = collections.deque()
+
+    def __len__(self):
+        return len(self._queue)
+
+    def __iter__(self):
+        return itertools.chain(self._queue, (message for message, _ in self._waiting))
+
+    def put(self, message, accepted=None):
+        if len(self._queue) >= self.capacity:
+            if accepted is None:
+                self.dropped += 1
+            else:
+                self.waited += 1
+                self._waiting.append((message, accepted))
+            return False
+        self._queue.append(message)
+        self.high_water = max(self.high_water, len(self._queue))
+        return True
+
+    def restore(self, message):
+        """
+        Puts back a saved message, which waits for room if it doesn't fit.
+        """
+        if len(self._queue) >= self.capacity:
+            self._waiting.append((message, None))
+        else:
+            self._queue.append(message)
+
+    def get(self):
+        self.delivered += 1
+        message = self._queue.popleft()
+        if self._waiting:
+            waiting, accepted = self._waiting.popleft()
+            self._queue.append(waiting)
+            if accepted is not None:
+                accepted()
+        return message
+
+    def clear(self):
+        """
+        Empties the mailbox, returning every message in it. The senders of
+        messages waiting for room are let go as if they'd been accepted.
+        """
+        messages = list(self)
+        waiting = list(self._waiting)
+        self._queue.clear()
+        self._waiting.clear()
+        for _, accepted in waiting:
+            if accepted is not None:
+                accepted()
+        return messages
+
+    def to_dict(self):
+        return collections.OrderedDict([
+            ('depth', len(self._queue)),
+            ('capacity', self.capacity),
+            ('delivered', self.delivered),
+            ('waiting', len(self._waiting)),
+            ('waited', self.waited),
+            ('dropped', self.dropped),
+            ('high_water', self.high_water),
+        ])
 
 class Process(object):
     """
     Base class for all processes (emulated or virtual).
     """
 
+    # name the process is recreated from when its machine is restored, None
+    # for processes that aren't saved with their machine
+    KIND = None
+
+    # the pool the process is handed back to once it's killed, if any
+    pool = None
+
     def __init__(self, machine, pid, ppid):
+        self.attach(machine, pid, ppid)
+
+    def attach(self, machine, pid, ppid):
         self.logger = machine.logger.getChild('processes.{}'.format(pid))
         self.machine = machine
         self.pid = pid
         self.ppid = ppid
+        # responses are tagged with this so that ones for a pid's earlier
+        # owner, or a pooled process's, are ignored
+        self.generation = next(_generations)
         self.logger.debug('new process: ppid={}'.format(ppid))
 
     async def send_ipc(self, sender, values):
+        # the message is delivered between ticks and the response is picked
+        # up on the loop whenever the process gets round to replying
+        future = asyncio.Future()
+        universe = self.machine.universe
+
+        def reply(values):
+            universe.on_loop(_resolve, future, values)
+
+        def deliver():
+            try:
+                self.deliver(sender, values, reply)
+            except MailboxFull as ex:
+                universe.on_loop(_fail, future, ex)
+
+        universe.between_ticks(deliver)
+        return await future
+
+    def deliver(self, sender, values, reply=None, accepted=None):
+        """
+        Delivers a message synchronously, calling reply with the response (if
+        the sender wants one) once there is one. Processes on the same machine
+        talk to each other this way, without going through the event loop.
+        If the process can't take any more messages, the message waits for
+        room and False is returned when accepted is given (which is called
+        once it's taken), otherwise MailboxFull is raised.
+        """
+        response = self.handle_ipc(sender, values)
+        if self.KIND is not None:
+            self.machine.mark_dirty(self)
+        if reply is not None:
+            reply(response)
+        return True
+
+    def handle_ipc(self, sender, values):
         return None
 
     def kill(self):
         pass
 
+    def is_idle(self):
+        """
+        Whether the process has nothing in flight, so its machine can be
+        unloaded and later restored without it noticing.
+        """
+        return True
+
+    @property
+    def halted(self):
+        """
+        Whether the process has finished and won't handle any more messages.
+        """
+        return False
+
+    def get_state(self):
+        return {}
+
+    def get_log_state(self):
+        """
+        The state logged when only this process has changed, which is
+        merge_log_state'd back into the last full state when restoring.
+        """
+        return self.get_state()
+
+    @classmethod
+    def merge_log_state(cls, state, log_state):
+        return log_state
+
+    def set_state(self, state):
+        pass
+
+    def release(self):
+        """
+        Stops the process taking part in ticks and timers, for when its
+        machine is unloaded.
+        """
+        pass
+
 class EmuProcess(Process):
     STATE_IDLE = 0
     STATE_RUNNING = 1
     STATE_BLOCKED = 2
-    
-    def __init__(self, machine, pid, ppid):
-        super(EmuProcess, self).__init__(machine, pid, ppid)
 
-        self.steps_per_tick = 150
-        self.receive_future = None
-        self.receive_sender = None
+    KIND = 'emu'
+
+    # messages that can wait for the process to receive them
+    MAILBOX_SIZE = 32
+    
+    def __init__(self, machine=None, pid=None, ppid=None):
+        self.generation = None
 
         self.emu = emu.Emulator(verbose=100)
-        self.emu.logger = self.logger
         self.emu.hook_error(self._on_error)
         self.emu.hook_halted(self._on_halted)
         self.emu.hook_send(self._on_send)
         self.emu.hook_block(self._on_block)
         self.emu.hook_resume(self._on_resume)
 
+        # pooled processes are built without a machine and attached later
+        self.machine = None
+        if machine is not None:
+            self.attach(machine, pid, ppid)
+
+    def attach(self, machine, pid, ppid):
+        super(EmuProcess, self).attach(machine, pid, ppid)
+        self.emu.logger = self.logger
+
+        # everything is set up afresh so nothing is carried over from the
+        # process's last owner when it came from a pool
+        self.steps_per_tick = 150
+        self.mailbox = Mailbox(self.MAILBOX_SIZE)
+        self.receiving = False
+        self.receive_sender = None
+        # answers whoever sent the message being handled, if they want a reply
+        self.reply = None
+        self.tick_id = None
+        self.timer = None
+        # counts blocks, so a timeout deferred for a block that has already
+        # ended by the time it would be armed can tell and isn't armed
+        self.blocks = 0
+        # messages this process sent that are waiting for room in a full
+        # mailbox, it's held in SEND_FULL until they've all been accepted
+        self.held_sends = 0
+        # a process can be run several times in a tick if messages wake it,
+        # but only gets steps_per_tick steps across all of them
+        self.steps_tick = None
+        self.steps_left = 0
+
+    def detach(self):
+        """
+        Wipes a killed process so it can be handed to another owner.
+        """
+        self.generation = None
+        # the emulator is reset without the machine hearing it halt
+        self.machine = None
+        self.emu.reset()
+        self.emu.set_program([])
+        ssp.logging.forget_logger(self.logger)
+        self.emu.logger = emu.Emulator.logger
+        self.logger = None
+        self.pid = None
+        self.ppid = None
+        self.mailbox = None
+        self.reply = None
+        self.receive_sender = None
+
     def _on_error(self, emu, err, addr):
         self.logger.error("error[0x{:04X}]: {}".format(addr, err))
 
     def _on_halted(self, emu):
+        if self.machine is None:
+            return
         self.logger.info("halted")
+        if self.tick_id is not None:
+            self.machine.sleep(self.tick_id)
+        self.machine.events.emit('process_halted', self)
                 
     def _on_send(self, emu, target, values):
+        # the emulator blocks before the send hook when it wants a response
+        wants_response = self.emu.blocked
+
         if target == ".":
             target = str(self.ppid)
-        elif (self.receive_future is not None) and (target == self.receive_sender):
-            self.receive_future.set_result(values)
+        elif (self.reply is not None) and (target == self.receive_sender):
+            reply, self.reply = self.reply, None
+            reply(values)
+            return
+
+        # processes on the same machine are ticked together, so they can be
+        # handed the message directly within the tick
+        local = self.machine.local_process(target)
+        if local is not None:
+            reply = None
+            if wants_response:
+                reply = functools.partial(self.receive_response, generation=self.generation)
+            trace = self._trace(target, local.KIND == EmuProcess.KIND, wants_response)
+            if (trace is not None) and wants_response:
+                reply = functools.partial(self._traced_response, trace, self.generation)
+            accepted = functools.partial(self.send_accepted, self.generation)
+            if not local.deliver(str(self.pid), values, reply, accepted):
+                self.send_held(self.generation)
+            if trace is not None:
+                self.machine.universe.tracer.delivered(trace)
+            return
+
+        # messages for other machines are batched up and delivered at the
+        # end of the tick
+        if self.machine.send_remote(self.pid, self.generation, target, values, wants_response):
+            return
+
+        # other sends happen during a tick, which may not be on the event
+        # loop's thread, so the actual IPC is started when the outbox is flushed
+        self.machine.universe.defer(self._start_send, target, values, wants_response)
+
+    def receive_response(self, values, generation=None):
+        """
+        Hands the process the response to its send, unless it's for an
+        earlier generation of the process.
+        """
+        if (generation is not None) and (generation != self.generation):
             return
+        self.emu.receive(None, values)
+
+    def _trace(self, target, to_process, wants_response):
+        tracer = self.machine.universe.tracer
+        if tracer is None:
+            return None
+        kind = IpcTracer.KIND_LOCAL if to_process else IpcTracer.KIND_SERVICE
+        return tracer.start(self.machine.id, target, kind, wants_response)
+
+    def _traced_response(self, trace, generation, values):
+        self.receive_response(values, generation)
+        self.machine.universe.tracer.responded(trace)
+
+    def send_failed(self, exc, generation=None):
+        if (generation is not None) and (generation != self.generation):
+            return
+        self.emu.trigger_error('error sending: {}'.format(repr(exc)))
+
+    def send_held(self, generation=None):
+        """
+        Told that a message the process sent is waiting for room in the
+        receiver's mailbox. The process stops running until it's accepted,
+        rather than the message being dropped.
+        """
+        if (generation is not None) and (generation != self.generation):
+            return
+        self.held_sends += 1
+        if self.emu.running:
+            self.emu.hold_send()
+
+    def send_accepted(self, generation=None):
+        if (generation is not None) and (generation != self.generation):
+            return
+        self.held_sends -= 1
+        if (self.held_sends == 0) and self.emu.blocked and \
+                (self.emu.blocking_reason == emu.BlockingReason.SEND_FULL):
+            self.emu.resume()
+
+    def _start_send(self, target, values, wants_response):
+        universe = self.machine.universe
+        generation = self.generation
 
         self.logger.info("sending {} to {}".format(values, target))
 
         def done(future):
             exc = future.exception()
             if exc is not None:
-                emu.trigger_error('error sending: {}'.format(repr(exc)))
+                universe.between_ticks(self.send_failed, exc, generation)
                 raise exc
             
-            emu.receive(None, future.result())
+            universe.between_ticks(self.receive_response, future.result(), generation)
         
-        future = asyncio.get_event_loop().create_task(self.machine.send_ipc(str(self.pid), target, values))
-        if self.emu.blocked:
+        future = self.machine.universe.start_ipc(self.machine.send_ipc(str(self.pid), target, values))
+        if wants_response:
             future.add_done_callback(done)
         
     def _on_block(self, e, reason):
         self.logger.debug("blocked on {}".format(emu.BlockingReason.to_string(reason)))
-        self.machine.unregister_tick(self.tick_id)
+        self.machine.sleep(self.tick_id)
+        self.blocks += 1
 
         if reason in (emu.BlockingReason.RECV, emu.BlockingReason.LISTEN):
-            self.receive_future = asyncio.Future()
+            if len(self.mailbox) > 0:
+                # a message is already waiting, so there's nothing to time out
+                self._receive(*self.mailbox.get())
+                return
+            self.receiving = True
+
+        if e.block_timeout is not None:
+            self.machine.universe.defer(
+                self._start_timer, self.blocks, reason, e.block_timeout
+            )
+
+    def _start_timer(self, block, reason, timeout):
+        # a message may have woken the process later in the tick it blocked in
+        if (block != self.blocks) or not self.emu.blocked:
+            return
+        universe = self.machine.universe
+        self.timer = universe.timers.schedule(
+            universe.ticks_for(timeout), self._on_timer, reason
+        )
+
+    def _on_timer(self, reason):
+        self.timer = None
+        if not self.emu.blocked:
+            return
+        if reason == emu.BlockingReason.SLEEP:
+            self.emu.resume()
+        else:
+            self.receiving = False
+            self.emu.receive_timeout()
 
     def _on_resume(self, e):
-        self.tick_id = self.machine.register_tick(self._on_tick)
+        self.blocks += 1
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+        # processes are registered with the scheduler once, then only woken
+        # when they become runnable and put to sleep when they block or halt
+        if self.tick_id is None:
+            self.tick_id = self.machine.register_tick(
+                self._on_tick, owner=(self.machine.id, self.pid)
+            )
+        else:
+            self.machine.wake(self.tick_id)
 
     def _on_tick(self):
-        for _ in range(self.steps_per_tick):
+        now = self.machine.universe.timers.now
+        if self.steps_tick != now:
+            self.steps_tick = now
+            self.steps_left = self.steps_per_tick
+
+        self.machine.mark_dirty(self)
+        if self.held_sends > 0:
+            # woken (e.g. by a message) while a remote send was still waiting
+            # for room
+            self.emu.hold_send()
+            return
+
+        steps = 0
+        while steps < self.steps_left:
             self.emu.single_step()
-            if self.emu.blocked:
+            steps += 1
+            if not self.emu.running:
                 break
+        self.steps_left -= steps
+        self.machine.universe.instructions += steps
+
+    def deliver(self, sender, values, reply=None, accepted=None):
+        if self.machine is None:
+            # recycled while the message was on its way
+            if reply is not None:
+                reply(None)
+            return True
 
-    async def send_ipc(self, sender, values):
         self.logger.debug('receive {}, {}'.format(sender, values))
-        if self.receive_future is None:
-            return
+        taken = True
+        if self.receiving:
+            self._receive(sender, values, reply)
+        elif not self.mailbox.put((sender, values, reply), accepted):
+            if accepted is None:
+                raise MailboxFull('mailbox of process {} is full'.format(self.pid))
+            taken = False
+        self.machine.mark_dirty(self)
+        return taken
+
+    def _receive(self, sender, values, reply):
+        if self.reply is not None:
+            # the process moved on without answering the last sender
+            self.reply(None)
 
+        self.receiving = False
         self.receive_sender = sender
+        self.reply = reply
         self.emu.receive(sender, values)
-        return await self.receive_future
+
+    def kill(self):
+        # the process may be killed in the middle of its own tick (e.g. by
+        # asking sys to let it exit), so it's stopped straight away
+        self.emu.halt()
+        self.machine.universe.between_ticks(self._kill)
+
+    def _kill(self):
+        self.release()
+
+        # nobody is going to answer these now
+        pending = [message[2] for message in self.mailbox.clear()]
+        pending.append(self.reply)
+        self.reply = None
+        for reply in pending:
+            if reply is not None:
+                reply(None)
+        self.machine.universe.scheduler.forget((self.machine.id, self.pid))
+
+        if self.pool is not None:
+            self.pool.recycle(self)
+
+    def release(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.tick_id is not None:
+            self.machine.unregister_tick(self.tick_id)
+            self.tick_id = None
+
+    def is_idle(self):
+        if self.emu.running or (self.reply is not None) or (len(self.mailbox) > 0):
+            return False
+        if self.held_sends > 0:
+            return False
+        # a hibernating machine isn't ticked, so its timers would only fire
+        # once something woke it
+        if (self.timer is not None) and not self.timer.cancelled:
+            return False
+        return not (self.emu.blocked and
+            self.emu.blocking_reason == emu.BlockingReason.SEND_RESP)
+
+    @property
+    def halted(self):
+        return self.emu.state == emu.EmulatorState.HALTED
+
+    def get_state(self, include_program=True):
+        timer = None
+        if (self.timer is not None) and not self.timer.cancelled:
+            timer = [self.timer.args[0], self.timer.expires]
+
+        return {
+            'emu': self.emu.get_state(include_program),
+            'steps_per_tick': self.steps_per_tick,
+            'receive_sender': self.receive_sender,
+            'timer': timer,
+            'pooled': self.pool is not None,
+            # replies can't be saved, so restored messages aren't answered
+            'mailbox': [[sender, values] for sender, values, _ in self.mailbox],
+        }
+
+    def get_log_state(self):
+        # the program only changes when the process is started, which logs
+        # the whole machine
+        return self.get_state(include_program=False)
+
+    @classmethod
+    def merge_log_state(cls, state, log_state):
+        log_state['emu']['program'] = state['emu']['program']
+        return log_state
+
+    def set_state(self, state):
+        self.emu.set_state(state['emu'])
+        self.steps_per_tick = state['steps_per_tick']
+        self.receive_sender = state['receive_sender']
+        if state.get('pooled'):
+            self.pool = self.machine.universe.process_pool
+        for sender, values in state.get('mailbox', []):
+            self.mailbox.restore((sender, values, None))
+
+        if self.emu.running:
+            self.tick_id = self.machine.register_tick(
+                self._on_tick, owner=(self.machine.id, self.pid)
+            )
+        elif self.emu.blocking_reason in (emu.BlockingReason.RECV, emu.BlockingReason.LISTEN):
+            self.receiving = True
+        elif self.emu.blocking_reason == emu.BlockingReason.SEND_FULL:
+            # the messages it was held for were saved with their receivers
+            self.emu.resume()
+
+        if state['timer'] is not None:
+            reason, expires = state['timer']
+            timers = self.machine.universe.timers
+            self.timer = timers.schedule(expires - timers.now, self._on_timer, reason)
 
     def run_program(self, program):
+        self.machine.universe.between_ticks(self._run_program, program)
+
+    def _run_program(self, program):
         if self.emu.state == emu.EmulatorState.HALTED:
             self.emu.set_program(program)
             self.emu.resume()
+            self.machine.mark_dirty()
+
+class ProcessPool(object):
+    """
+    Pre-built EmuProcesses (emulator created and hooked up) handed out to
+    machines when processes are started. Processes taken from the pool are
+    recycled into it when they're killed, e.g. by exiting through the sys
+    service, or their machine is unloaded.
+    """
+
+    def __init__(self, size=64):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self.recycled = 0
+        self._free = collections.deque()
+
+    def __len__(self):
+        return len(self._free)
+
+    def warm(self):
+        while len(self._free) < self.size:
+            self._free.append(EmuProcess())
+
+    def acquire(self, machine, pid, ppid):
+        if len(self._free) > 0:
+            self.hits += 1
+            proc = self._free.pop()
+            proc.attach(machine, pid, ppid)
+        else:
+            self.misses += 1
+            proc = EmuProcess(machine, pid, ppid)
+        proc.pool = self
+        return proc
+
+    def recycle(self, proc):
+        proc.detach()
+        if len(self._free) < self.size:
+            self.recycled += 1
+            self._free.append(proc)
+
+    def to_dict(self):
+        return collections.OrderedDict([
+            ('size', self.size),
+            ('free', len(self._free)),
+            ('hits', self.hits),
+            ('misses', self.misses),
+            ('recycled', self.recycled),
+        ])
+
+
+def _resolve(future, result):
+    # the caller may have given up waiting, e.g. its HTTP stream was closed
+    if not future.done():
+        future.set_result(result)
+
+def _fail(future, exc):
+    if not future.done():
+        future.set_exception(exc)
@@ -0,0 +1,99 @@
+import collections
+import time
+
+from . import idlist
+
+class Scheduler(object):
+    """
+    Round-robin run queue of tickers with an optional wall-clock budget per
+    tick. Tickers that don't get to run before the budget runs out stay at the
+    front of the queue and are the first to run next tick. Time spent in each
+    ticker is accounted to its owner so CPU share can be reported per process.
+
+    Registered tickers are only in the run queue while they're runnable, they
+    are taken off it with sleep (e.g. when blocked or halted) and put back on
+    with wake, so the cost of a tick depends on how many are runnable.
+    """
+
+    def __init__(self, budget=None, clock=time.perf_counter):
+        self.budget = budget
+        self.clock = clock
+        self.overruns = 0
+
+        self._id_generator = idlist.integer_id_generator(1337)
+        self._tickers = {}
+        self._owners = {}
+        # the run queue holds (id, wake count) pairs, an entry is only live if
+        # its wake count matches the id's entry in _runnable, so sleeping
+        # doesn't have to search the queue
+        self._run_queue = collections.deque()
+        self._runnable = {}
+        self._wakes = 0
+        self._cpu_time = collections.defaultdict(float)
+
+    def __len__(self):
+        return len(self._tickers)
+
+    @property
+    def runnable_count(self):
+        return len(self._runnable)
+
+    def register_tick(self, cb, owner=None, runnable=True):
+        id = next(self._id_generator)
+        self._tickers[id] = cb
+        self._owners[id] = id if owner is None else owner
+        if runnable:
+            self.wake(id)
+        return id
+
+    def unregister_tick(self, id):
+        self.sleep(id)
+        del self._tickers[id]
+        del self._owners[id]
+
+    def wake(self, id):
+        if (id in self._runnable) or (id not in self._tickers):
+            return
+        self._wakes += 1
+        self._runnable[id] = self._wakes
+        self._run_queue.append((id, self._wakes))
+
+    def sleep(self, id):
+        # any entry left in the run queue is skipped when it comes up
+        self._runnable.pop(id, None)
+
+    def forget(self, owner):
+        self._cpu_time.pop(owner, None)
+
+    def tick(self):
+        clock = self.clock
+        deadline = None
+        if self.budget is not None:
+            deadline = clock() + self.budget
+
+        # tickers woken during the tick (e.g. by a message from another one)
+        # get to run in it too, but tickers that have already run and are
+        # still runnable wait for the next tick
+        requeue = []
+        while self._run_queue:
+            if (deadline is not None) and (clock() >= deadline):
+                self.overruns += 1
+                break
+
+            entry = self._run_queue.popleft()
+            id, wake = entry
+            if self._runnable.get(id) != wake:
+                continue
+
+            owner = self._owners[id]
+            start = clock()
+            self._tickers[id]()
+            self._cpu_time[owner] += clock() - start
+
+            if self._runnable.get(id) == wake:
+                requeue.append(entry)
+
+        self._run_queue.extend(requeue)
+
+    def cpu_time(self):
+        return dict(self._cpu_time)
@@ -0,0 +1,45 @@
+import os
+import msgpack
+
+class MachineStore(object):
+    """
+    Keeps saved machine states on disk, one msgpack file per machine id.
+    Files are written to a temporary name and renamed into place so a crash
+    never leaves a half written machine behind.
+    """
+
+    SUFFIX = '.machine'
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def _path_for(self, id):
+        return os.path.join(self.path, '{}{}'.format(id, self.SUFFIX))
+
+    def __contains__(self, id):
+        return os.path.exists(self._path_for(id))
+
+    def ids(self):
+        return [
+            name[:-len(self.SUFFIX)]
+            for name in os.listdir(self.path)
+            if name.endswith(self.SUFFIX)
+        ]
+
+    def save(self, id, state):
+        path = self._path_for(id)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(msgpack.packb(state, use_bin_type=True))
+        os.replace(tmp_path, path)
+
+    def load(self, id):
+        with open(self._path_for(id), 'rb') as f:
+            return msgpack.unpackb(f.read(), encoding='utf8')
+
+    def delete(self, id):
+        try:
+            os.remove(self._path_for(id))
+        except FileNotFoundError:
+            pass
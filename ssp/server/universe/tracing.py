@@ -0,0 +1,215 @@
+import collections
+import itertools
+import threading
+import time
+
+from ..metrics import Histogram
+
+class Trace(object):
+    """
+    One traced message: when it was sent (enqueued), handed to its receiver
+    (delivered) and when the response got back to the sender (responded).
+    Times are from time.perf_counter, tick is the universe tick it was sent on.
+    """
+
+    __slots__ = (
+        'id', 'machine', 'target', 'kind', 'wants_response', 'tick',
+        'enqueued', 'delivered', 'responded', 'failed',
+    )
+
+    def __init__(self, id, machine, target, kind, wants_response, tick, enqueued):
+        self.id = id
+        self.machine = machine
+        self.target = target
+        self.kind = kind
+        self.wants_response = wants_response
+        self.tick = tick
+        self.enqueued = enqueued
+        self.delivered = None
+        self.responded = None
+        self.failed = False
+
+    @property
+    def latency(self):
+        """
+        Round trip time for messages wanting a response, otherwise the time
+        taken to deliver them.
+        """
+        end = self.responded if self.wants_response else self.delivered
+        if end is None:
+            return None
+        return end - self.enqueued
+
+    def to_dict(self):
+        return collections.OrderedDict([
+            ('id', self.id),
+            ('machine', self.machine),
+            ('target', self.target),
+            ('kind', self.kind),
+            ('tick', self.tick),
+            ('delivery', _since(self.enqueued, self.delivered)),
+            ('response', _since(self.enqueued, self.responded)),
+            ('failed', self.failed),
+        ])
+
+class TargetStats(object):
+    __slots__ = ('count', 'total', 'max')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, latency):
+        self.count += 1
+        self.total += latency
+        if latency > self.max:
+            self.max = latency
+
+    def to_dict(self):
+        return collections.OrderedDict([
+            ('count', self.count),
+            ('mean', self.total / self.count),
+            ('max', self.max),
+        ])
+
+class IpcTracer(object):
+    """
+    Opt-in tracing of IPC sent by emulated processes. Every sample_every'th
+    message is given an id and timestamped as it's sent, delivered and
+    answered, and the latencies go into histograms per kind of target
+    (another process on the machine, a service, or a remote machine) and
+    into per-machine stats of the slowest targets.
+
+    Unsampled messages cost a counter increment, so this is cheap enough to
+    leave on at a low rate. Ticks may run off the event loop's thread, so
+    messages are counted and traces recorded under a lock.
+    """
+
+    KIND_LOCAL = 'local'
+    KIND_SERVICE = 'service'
+    KIND_REMOTE = 'remote'
+    KINDS = (KIND_LOCAL, KIND_SERVICE, KIND_REMOTE)
+
+    # seconds, roughly logarithmic from 1us to 10s
+    BOUNDS = (
+        0.000001, 0.000002, 0.000005,
+        0.00001, 0.00002, 0.00005,
+    ) + Histogram.DEFAULT_BOUNDS
+
+    # targets remembered per machine, the fastest are forgotten first
+    MAX_TARGETS = 64
+
+    def __init__(self, universe, sample_every=1, top_n=10, recent=256):
+        self.universe = universe
+        self.sample_every = max(1, sample_every)
+        self.top_n = top_n
+
+        self.sent = 0
+        self.traced = 0
+        self.failures = dict((kind, 0) for kind in self.KINDS)
+        self.delivery = dict((kind, Histogram(self.BOUNDS)) for kind in self.KINDS)
+        self.round_trip = dict((kind, Histogram(self.BOUNDS)) for kind in self.KINDS)
+        # machine id -> target -> TargetStats
+        self.targets = {}
+        self.recent = collections.deque(maxlen=recent)
+
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+        universe.tracer = self
+
+    def start(self, machine_id, target, kind, wants_response):
+        """
+        Starts a trace for a message being sent, or returns None if it isn't
+        sampled.
+        """
+        with self._lock:
+            self.sent += 1
+            if self.sent % self.sample_every != 0:
+                return None
+            id = next(self._ids)
+        return Trace(id, machine_id, target, kind, wants_response,
+            self.universe.timers.now, time.perf_counter())
+
+    def delivered(self, trace):
+        if trace.delivered is not None:
+            return
+        trace.delivered = time.perf_counter()
+        if not trace.wants_response:
+            self._finish(trace)
+
+    def responded(self, trace):
+        trace.responded = time.perf_counter()
+        # services answer as they're handed the message
+        if trace.delivered is None:
+            trace.delivered = trace.responded
+        self._finish(trace)
+
+    def failed(self, trace):
+        trace.failed = True
+        self._finish(trace)
+
+    def _finish(self, trace):
+        with self._lock:
+            self.traced += 1
+            self.recent.append(trace)
+
+            if trace.failed:
+                self.failures[trace.kind] += 1
+                return
+
+            self.delivery[trace.kind].record(trace.delivered - trace.enqueued)
+            if trace.wants_response:
+                self.round_trip[trace.kind].record(trace.responded - trace.enqueued)
+
+            targets = self.targets.get(trace.machine)
+            if targets is None:
+                targets = self.targets[trace.machine] = {}
+            stats = targets.get(trace.target)
+            if stats is None:
+                if len(targets) >= self.MAX_TARGETS:
+                    fastest = min(targets, key=lambda target: targets[target].max)
+                    del targets[fastest]
+                stats = targets[trace.target] = TargetStats()
+            stats.record(trace.latency)
+
+    def slowest_targets(self, machine_id):
+        """
+        The machine's top_n targets by their worst latency, slowest first.
+        """
+        with self._lock:
+            targets = list(self.targets.get(machine_id, {}).items())
+        targets.sort(key=lambda item: item[1].max, reverse=True)
+        return [
+            [target, stats.to_dict()]
+            for target, stats in targets[:self.top_n]
+        ]
+
+    def forget_machine(self, machine_id):
+        with self._lock:
+            self.targets.pop(machine_id, None)
+
+    def to_dict(self, recent=False):
+        with self._lock:
+            result = collections.OrderedDict([
+                ('sample_every', self.sample_every),
+                ('sent', self.sent),
+                ('traced', self.traced),
+                ('kinds', collections.OrderedDict(
+                    (kind, collections.OrderedDict([
+                        ('failures', self.failures[kind]),
+                        ('delivery', self.delivery[kind].to_dict()),
+                        ('round_trip', self.round_trip[kind].to_dict()),
+                    ]))
+                    for kind in self.KINDS
+                )),
+            ])
+            if recent:
+                result['recent'] = [trace.to_dict() for trace in self.recent]
+        return result
+
+def _since(start, end):
+    if end is None:
+        return None
+    return end - start
@@ -1,40 +1,321 @@
+import asyncio
+import collections
 import logging
-from . import machine, idlist
+import math
+import time
+from . import machine, idlist, scheduler, process
+from ..timers import TimerWheel
 
 class Universe(object):
     logger = logging.getLogger(__name__)
 
+    # offered to player machines but only started when first sent to, after
+    # which they run for as long as the machine does
     PLAYER_SERVICES = [
         'fs',
         'sys',
+        'chan',
     ]
     
-    def __init__(self):
-        self.tickers = idlist.IdList(idlist.integer_id_generator(1337))
+    TICK_TIME = 0.1
+
+    def __init__(self, tick_budget=None,
+            store=None, hibernate_after=None, process_pool_size=64):
+        self.scheduler = scheduler.Scheduler(budget=tick_budget)
+        # ticks may run off the event loop's thread, so anything that has to
+        # run on the loop (starting IPC, resolving futures) is deferred into
+        # the outbox and flushed on the loop once the tick is finished
+        self.outbox = []
+        # messages for machines, batched per destination machine id and
+        # delivered at the end of the tick
+        self.batches = collections.OrderedDict()
+        self.instructions = 0
+        self.ticking = False
+        self.tick_time = self.TICK_TIME
+        self.timers = TimerWheel()
+        self.between_tick_calls = []
+        self.ipc_started = 0
+        self.ipc_finished = 0
+        # an IpcTracer, if IPC is being traced
+        self.tracer = None
+        self.process_pool = process.ProcessPool(process_pool_size)
+        self.process_pool.warm()
         self.machines = idlist.IdList(idlist.random_string_id_generator())
+        # secrets are generated in batches like the ids, for the same reason
+        self.secrets = idlist.random_string_id_generator(length=40)
+
+        # idle machines are saved to the store and unloaded once they haven't
+        # been accessed for hibernate_after seconds, and loaded again the
+        # next time they're looked up
+        self.store = store
+        self.hibernate_after = hibernate_after
+        # hibernating machine ids and their secrets, so requests for them can
+        # be authenticated without waking them. The secrets of machines that
+        # were hibernating when the server started are read from the store
+        # the first time they're needed
+        self.hibernated = dict.fromkeys(store.ids()) if store is not None else {}
+        self.last_access = collections.OrderedDict()
+
+        # set by Persistence, which is told about every machine that changes
+        self.persistence = None
 
-        test_machine = machine.Machine(self, 'test')
-        self.machines['test'] = test_machine
-        test_machine.start_builtin_service('fs')
+        if 'test' in self.hibernated:
+            self.get_machine('test')
+        else:
+            test_machine = machine.Machine(self, 'test')
+            self.machines['test'] = test_machine
+            test_machine.add_lazy_service('fs')
+            self.touch('test')
     
     def tick(self):
-        for v in list(self.tickers.values()):
-            v()
+        self.start_tick()
+        try:
+            self.step()
+        finally:
+            self.finish_tick()
+
+    def start_tick(self):
+        self.timers.advance()
+        self.ticking = True
+
+    def skip_ticks(self, ticks):
+        # ticks the server dropped still count towards timers
+        self.timers.advance(ticks)
+
+    def ticks_for(self, milliseconds):
+        return int(math.ceil(milliseconds / 1000.0 / self.tick_time))
+
+    def step(self):
+        """
+        Runs the tickers for one tick. This doesn't touch the event loop, so
+        it can be run off the loop's thread between start_tick and
+        finish_tick.
+        """
+        self.scheduler.tick()
+
+    def finish_tick(self):
+        self.ticking = False
+
+        outbox, self.outbox = self.outbox, []
+        for fn, args in outbox:
+            fn(*args)
+
+        self.deliver_batches()
 
-    def register_tick(self, cb):
-        return self.tickers.add(cb)
+        calls, self.between_tick_calls = self.between_tick_calls, []
+        for fn, args in calls:
+            fn(*args)
+
+        if self.hibernation_enabled:
+            self.hibernate_idle()
+
+        if self.persistence is not None:
+            self.persistence.on_tick()
+
+    def register_tick(self, cb, owner=None, runnable=True):
+        return self.scheduler.register_tick(cb, owner, runnable)
 
     def unregister_tick(self, id):
-        del self.tickers[id]
+        self.scheduler.unregister_tick(id)
+
+    def wake(self, id):
+        self.scheduler.wake(id)
+
+    def sleep(self, id):
+        self.scheduler.sleep(id)
+
+    def defer(self, fn, *args):
+        self.outbox.append((fn, args))
+
+    def post(self, machine_id, fn, *args):
+        """
+        Queues fn(universe, machine_id, machine, *args) to be called once the
+        tick is finished, machine being None if there's no such machine.
+        """
+        batch = self.batches.get(machine_id)
+        if batch is None:
+            batch = self.batches[machine_id] = []
+        batch.append((fn, args))
+
+    def on_loop(self, fn, *args):
+        """
+        Calls fn now if the universe isn't mid-tick, otherwise defers it until
+        the outbox is flushed on the loop.
+        """
+        if self.ticking:
+            self.defer(fn, *args)
+        else:
+            fn(*args)
+
+    def deliver_batches(self):
+        # batches are delivered in the order they were started, so everything
+        # one process sends to a machine arrives in the order it was sent.
+        # Deliveries can post more (e.g. a service replying straight away),
+        # which are delivered too
+        while self.batches:
+            batches, self.batches = self.batches, collections.OrderedDict()
+            for machine_id, batch in batches.items():
+                mach = self.get_machine(machine_id)
+                for fn, args in batch:
+                    fn(self, machine_id, mach, *args)
+
+    def between_ticks(self, fn, *args):
+        """
+        Calls fn now, or once the current tick is finished if the tickers are
+        being run off the event loop, for anything that touches emulator or
+        scheduler state from the loop.
+        """
+        if self.ticking:
+            self.between_tick_calls.append((fn, args))
+        else:
+            fn(*args)
+
+    def start_ipc(self, coro):
+        """
+        Runs an IPC coroutine started by a process as a task on the loop,
+        counting it so Server.settle_ipc can tell when IPC has settled.
+        """
+        self.ipc_started += 1
+        task = asyncio.get_event_loop().create_task(coro)
+        task.add_done_callback(self._ipc_done)
+        return task
+
+    def _ipc_done(self, task):
+        self.ipc_finished += 1
+
+    def cpu_share(self):
+        """
+        Fraction of tick time spent in each (machine id, pid).
+        """
+        cpu_time = self.scheduler.cpu_time()
+        total = sum(cpu_time.values())
+        if total <= 0:
+            return {}
+        return dict(
+            (owner, spent / total)
+            for owner, spent in cpu_time.items()
+        )
 
     def create_machine(self, ctor=machine.Machine):
-        id = self.machines.add_fn(lambda id: ctor(self, id))
-        machine = self.machines[id]
+        while True:
+            id = self.machines.generate_id()
+            if id not in self.hibernated:
+                break
+        machine = ctor(self, id, next(self.secrets))
+        self.machines[id] = machine
+        self.touch(id)
+        self.mark_dirty(id)
         return machine
 
+    @property
+    def hibernation_enabled(self):
+        return (self.store is not None) and (self.hibernate_after is not None)
+
+    def get_machine(self, id):
+        """
+        Looks up a machine by id, waking it first if it's hibernating.
+        """
+        mach = self.machines.get(id)
+        if (mach is None) and (id in self.hibernated):
+            mach = self.wake_machine(id)
+        if mach is not None:
+            self.touch(id)
+        return mach
+
+    def machine_secret(self, id):
+        """
+        Looks up a machine's secret without waking it, None if there's no
+        such machine.
+        """
+        mach = self.machines.get(id)
+        if mach is not None:
+            return mach.secret
+        if id not in self.hibernated:
+            return None
+        secret = self.hibernated[id]
+        if secret is None:
+            secret = self.hibernated[id] = self.store.load(id)['secret']
+        return secret
+
+    def mark_dirty(self, id, pid=None):
+        if self.persistence is not None:
+            self.persistence.mark_dirty(id, pid)
+
+    def touch(self, id):
+        if self.hibernation_enabled:
+            self.last_access[id] = time.monotonic()
+            self.last_access.move_to_end(id)
+
+    def hibernate_idle(self, now=None):
+        """
+        Hibernates machines that haven't been accessed recently. Machines are
+        kept in order of last access, so this stops at the first recent one.
+        """
+        if now is None:
+            now = time.monotonic()
+        cutoff = now - self.hibernate_after
+
+        for _ in range(len(self.last_access)):
+            id, last_access = next(iter(self.last_access.items()))
+            if last_access > cutoff:
+                break
+
+            mach = self.machines.get(id)
+            if mach is None:
+                del self.last_access[id]
+            elif mach.is_idle():
+                self.hibernate_machine(mach)
+            else:
+                # busy machines are checked again after another full period
+                self.last_access[id] = now
+                self.last_access.move_to_end(id)
+
+    def hibernate_machine(self, mach):
+        self.logger.info('hibernating machine {}'.format(mach.id))
+        self.store.save(mach.id, mach.get_state())
+        mach.unload()
+        del self.machines[mach.id]
+        self.last_access.pop(mach.id, None)
+        self.hibernated[mach.id] = mach.secret
+        if self.persistence is not None:
+            self.persistence.machine_removed(mach.id)
+
+    def remove_machine(self, id):
+        """
+        Deletes a loaded machine for good, without saving it.
+        """
+        mach = self.machines.get(id)
+        if mach is None:
+            return
+        self.logger.info('removing machine {}'.format(id))
+        mach.unload()
+        del self.machines[id]
+        self.last_access.pop(id, None)
+        if self.persistence is not None:
+            self.persistence.machine_removed(id)
+
+    def wake_machine(self, id):
+        self.logger.info('waking machine {}'.format(id))
+        mach = machine.Machine.from_state(self, self.store.load(id))
+        self.machines[id] = mach
+        self.hibernated.pop(id, None)
+        if self.persistence is not None:
+            # the saved state is only deleted once it's in the log
+            self.persistence.machine_woken(id)
+        else:
+            self.store.delete(id)
+        return mach
+
     def create_player_machine(self):
         mach = self.create_machine()
         for svc in self.PLAYER_SERVICES:
-            mach.start_builtin_service(svc)
+            mach.add_lazy_service(svc)
         return mach
-        
+
+    def create_player_machines(self, count):
+        """
+        Creates count player machines, yielding each as it's created so
+        callers can hand them out as they go.
+        """
+        for _ in range(count):
+            yield self.create_player_machine()